@@ -1,17 +1,40 @@
 """
 This script expands URLs (re-)tweeted by congressional Republicans during 2016-2020.
 
-Note: this project uses a [forked version of urlExpander](https://github.com/wlmwng/urlExpander)
-To check progress, `cd` to the output directory:
-- `wc -l urlexpander_modified.json` (number of URL entries in cache)
-- `tail -n 100 urlexpander_cache.jsonl | grep [URL domain]` (show last n URL entries which include the URL domain)
-- `tail -n 100 urlexpander_cache.jsonl | grep -v "\"response_code\": 2.*"` (show last n URL entries if their response codes were *not* 2XX; likely 4XX or 5XX)
+URLs are expanded with the async engine in url_expansion.py (per-domain connection limits,
+HEAD-first requests, cached redirect hops). Expanded URLs are kept in an indexed SQLite cache
+(expansion_cache.py); on the first run, the JSONL cache of the
+[forked version of urlExpander](https://github.com/wlmwng/urlExpander) used before is imported.
+By default, every URL is expanded and politicians_tweeted_urls_resolved.pkl is rebuilt
+together with its month partitions (see resolved_urls.py). With `--incremental`, only the rows
+after the watermark of the last run are expanded and appended to their month partitions:
+    python3 04_expand_tweeted_urls.py --incremental
+The month partitions are what 05-twitter-prep-urls-urlexpander.ipynb reads
+(resolved_urls.load_resolved_urls()); politicians_tweeted_urls_resolved.pkl is only
+rewritten by full runs and isn't updated by incremental ones.
+
+To check progress (from this directory):
+- `python3 expansion_cache.py ../../data/02-intermediate/02-twitter/urlexpander_cache.sqlite --progress`
+  (number of cached URLs per response class; add `--by-domain` for a breakdown per URL domain)
 """
 
-import os
+import argparse
 import datetime
+import os
+
 import pandas as pd
-import urlexpander
+
+from expansion_cache import SqliteExpansionCache
+from resolved_urls import (
+    DIR_PARTITIONS,
+    DIR_URL,
+    read_watermark,
+    select_new_rows,
+    write_partitions,
+    write_watermark,
+)
+from url_expansion import expand_urls, normalize_url
+from usrightmedia.shared.tweet_urls import read_tweet_urls
 
 # matplotlib is logged even though disable_existing_loggers=yes in logging_config.yaml
 # https://stackoverflow.com/a/51529172/7016397
@@ -23,53 +46,97 @@ from usrightmedia.shared.loggers import get_logger
 
 LOGGER = get_logger(filename=f"04-twitter-prep-urls-urlexpander", logger_type="main")
 
-dir_fig = os.path.join("..", "..", "figures")
-dir_url = os.path.join("..", "..", "data", "02-intermediate", "02-twitter")
-urls = pd.read_pickle(os.path.join(dir_url, f"politicians_tweeted_urls.pkl"))
-urls["created_week"] = urls["created_at"].dt.to_period("W").dt.to_timestamp()
-urls["created_month"] = urls["created_at"].dt.to_period("M").dt.to_timestamp()
-urls["created_year"] = urls["created_at"].dt.to_period("Y").dt.to_timestamp()
-LOGGER.info(
-    f"URLs (re-)tweeted by congressional Republicans during 2016-2020: {len(urls)}"
-)
 
-LOGGER.info(f"started url expansion at {datetime.datetime.now()}")
-resolved_urls = urlexpander.expand(
-    list(urls["most_unrolled_url"]),
-    chunksize=1280,
-    n_workers=4,
-    timeout=10,
-    cache_file=os.path.join(dir_url, "urlexpander_cache.jsonl"),
-    verbose=1,
-    filter_function=None,
-)
-LOGGER.info(f"finished url expansion at {datetime.datetime.now()}")
-
-# Join URLs from urlExpander to URLs from Twitter
-urls["resolved_url"] = resolved_urls
-
-urls = urls[
-    [
-        "tweet_id",
-        "created_at",
-        "created_week",
-        "created_month",
-        "created_year",
-        "text",
-        "author_id",
-        "username",
-        "tweet_url",
-        "url_id",
-        "url",
-        "expanded_url",
-        "display_url",
-        "unwound_url",
-        "most_unrolled_url",
-        "most_unrolled_field",
-        "is_dupe",
-        "is_from_tw",
-        "resolved_url",
-    ]
+COLUMNS = [
+    "tweet_id",
+    "created_at",
+    "created_week",
+    "created_month",
+    "created_year",
+    "text",
+    "author_id",
+    "username",
+    "tweet_url",
+    "url_id",
+    "url",
+    "expanded_url",
+    "display_url",
+    "unwound_url",
+    "most_unrolled_url",
+    "most_unrolled_field",
+    "is_dupe",
+    "is_from_tw",
+    "resolved_url",
 ]
 
-urls.to_pickle(os.path.join(dir_url, f"politicians_tweeted_urls_resolved.pkl"))
+
+def expand(urls):
+    """Add the created_* periods and the expanded "resolved_url" to the rows of urls."""
+    urls = urls.copy()
+    urls["created_week"] = urls["created_at"].dt.to_period("W").dt.to_timestamp()
+    urls["created_month"] = urls["created_at"].dt.to_period("M").dt.to_timestamp()
+    urls["created_year"] = urls["created_at"].dt.to_period("Y").dt.to_timestamp()
+
+    # the same link is often (re-)tweeted by many politicians: only expand each distinct URL once
+    urls["normalized_url"] = urls["most_unrolled_url"].map(normalize_url)
+    unique_urls = urls["normalized_url"].drop_duplicates().reset_index(drop=True)
+    LOGGER.info(
+        f"distinct URLs to expand: {len(unique_urls)} of {len(urls)} "
+        f"(dedup ratio: {len(urls) / max(len(unique_urls), 1):.2f}x)"
+    )
+
+    LOGGER.info(f"started url expansion at {datetime.datetime.now()}")
+    cache_file = os.path.join(DIR_URL, "urlexpander_cache.sqlite")
+    jsonl_cache_file = os.path.join(DIR_URL, "urlexpander_cache.jsonl")
+    is_new_cache = not os.path.exists(cache_file)
+    cache = SqliteExpansionCache(cache_file)
+    if is_new_cache and os.path.exists(jsonl_cache_file):
+        LOGGER.info(f"imported {cache.import_jsonl(jsonl_cache_file)} URLs from {jsonl_cache_file}")
+    try:
+        resolved_urls = expand_urls(
+            list(unique_urls),
+            cache=cache,
+            concurrency=200,
+            per_domain=8,
+            timeout=10,
+        )
+    finally:
+        cache.close()
+    LOGGER.info(f"finished url expansion at {datetime.datetime.now()}")
+
+    # Join the expanded URLs back to every URL from Twitter
+    df_resolved = pd.DataFrame({"normalized_url": unique_urls, "resolved_url": resolved_urls})
+    urls = urls.merge(df_resolved, on="normalized_url", how="left", validate="many_to_one")
+    return urls[COLUMNS]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expand URLs (re-)tweeted by congressional Republicans.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only expand the rows after the last run's watermark and append them to the month partitions",
+    )
+    args = parser.parse_args()
+
+    # external URLs, distinct within their tweet (written by 03-twitter-prep-urls.ipynb)
+    urls = read_tweet_urls(os.path.join(DIR_URL, "politicians_tweeted_urls.parquet"))
+    LOGGER.info(
+        f"URLs (re-)tweeted by congressional Republicans during 2016-2020: {len(urls)}"
+    )
+
+    if args.incremental:
+        watermark = read_watermark()
+        urls = select_new_rows(urls, watermark)
+        LOGGER.info(f"watermark: {watermark}; new URLs: {len(urls)}")
+        if urls.empty:
+            raise SystemExit(0)
+        urls = expand(urls)
+        months = write_partitions(urls, append=True)
+        LOGGER.info(f"appended {len(urls)} URLs to the partitions {months} in {DIR_PARTITIONS}")
+    else:
+        urls = expand(urls)
+        urls.to_pickle(os.path.join(DIR_URL, f"politicians_tweeted_urls_resolved.pkl"))
+        write_partitions(urls, append=False)
+
+    write_watermark(urls)
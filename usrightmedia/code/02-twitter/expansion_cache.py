@@ -0,0 +1,211 @@
+"""
+Indexed SQLite store for expanded URLs (replaces the append-only urlexpander_cache.jsonl).
+
+One row per (normalized) URL, upserted in place:
+    url, domain, resolved_url, response_code, n_hops, error, updated_at
+`domain` and `response_code` are indexed, so progress queries don't scan the cache.
+
+Entries with a 4XX/5XX response code or an error expire after `error_ttl` seconds:
+get() then returns None and the URL is expanded again. Entries imported from
+urlexpander's JSONL cache without a response code or with one of its error markers
+(__CLIENT_ERROR__, __CONNECTIONPOOL_ERROR__) are imported as already expired errors.
+
+Usage as a command-line tool ([cache] is ../../data/02-intermediate/02-twitter/urlexpander_cache.sqlite):
+    python3 expansion_cache.py [cache] --import-jsonl [jsonl]   # import urlexpander's JSONL cache
+    python3 expansion_cache.py [cache] --progress               # totals per response class
+    python3 expansion_cache.py [cache] --progress --by-domain   # ... per domain
+    python3 expansion_cache.py [cache] --compact                # drop expired errors, VACUUM
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+
+import pandas as pd
+
+from url_expansion import get_netloc, normalize_url
+
+# seconds before a 4XX/5XX response is checked again
+ERROR_TTL = 7 * 24 * 60 * 60
+
+
+class SqliteExpansionCache:
+    """Expansion cache used by url_expansion.expand_urls() (get/set of entries by URL).
+
+    Args:
+        path (str): SQLite file
+        error_ttl (float): seconds after which 4XX/5XX entries are re-checked
+        commit_every (int): number of set() calls per transaction
+
+    """
+
+    def __init__(self, path, error_ttl=ERROR_TTL, commit_every=500):
+        self.path = path
+        self.error_ttl = error_ttl
+        self.commit_every = commit_every
+        self._n_uncommitted = 0
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS expansions (
+                url TEXT PRIMARY KEY,
+                domain TEXT,
+                resolved_url TEXT,
+                response_code INTEGER,
+                n_hops INTEGER,
+                error TEXT,
+                updated_at REAL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_domain ON expansions (domain)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_response_code ON expansions (response_code)"
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def count(self):
+        """Number of cached URLs (a full count: not meant for hot paths)."""
+        return self._conn.execute("SELECT COUNT(*) FROM expansions").fetchone()[0]
+
+    def _is_expired(self, response_code, error, updated_at, now=None):
+        is_error = error is not None or (response_code is not None and response_code >= 400)
+        return is_error and updated_at < (now or time.time()) - self.error_ttl
+
+    def get(self, url):
+        row = self._conn.execute(
+            "SELECT resolved_url, response_code, n_hops, error, updated_at "
+            "FROM expansions WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        resolved_url, response_code, n_hops, error, updated_at = row
+        if self._is_expired(response_code, error, updated_at):
+            return None
+        return {
+            "original_url": url,
+            "resolved_url": resolved_url,
+            "response_code": response_code,
+            "n_hops": n_hops,
+            "error": error,
+        }
+
+    def set(self, url, entry, updated_at=None):
+        self._conn.execute(
+            """INSERT INTO expansions VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET
+                domain = excluded.domain,
+                resolved_url = excluded.resolved_url,
+                response_code = excluded.response_code,
+                n_hops = excluded.n_hops,
+                error = excluded.error,
+                updated_at = excluded.updated_at""",
+            (
+                url,
+                get_netloc(url),
+                entry.get("resolved_url"),
+                entry.get("response_code"),
+                entry.get("n_hops"),
+                entry.get("error"),
+                time.time() if updated_at is None else updated_at,
+            ),
+        )
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._n_uncommitted = 0
+
+    def import_jsonl(self, path):
+        """Import urlexpander's JSONL cache; returns the number of imported entries.
+
+        URLs are stored under their normalize_url() key, like the lookups of 04_expand_tweeted_urls.py.
+        The imported entries are timestamped now, since the JSONL has no fetch times;
+        failed expansions are stored as errors which have already expired.
+        """
+        n = 0
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "original_url" not in entry:
+                    continue
+                resolved_url = entry.get("resolved_url") or ""
+                if entry.get("response_code") is None or "_ERROR__" in resolved_url:
+                    error = entry.get("error") or resolved_url.rsplit("/", 1)[-1] or "no response code"
+                    self.set(normalize_url(entry["original_url"]), dict(entry, error=error), updated_at=0.0)
+                else:
+                    self.set(normalize_url(entry["original_url"]), entry)
+                n += 1
+        self._conn.commit()
+        return n
+
+    def compact(self):
+        """Delete expired 4XX/5XX and error entries and reclaim the free space; returns the number deleted."""
+        deleted = self._conn.execute(
+            "DELETE FROM expansions WHERE (response_code >= 400 OR error IS NOT NULL) AND updated_at < ?",
+            (time.time() - self.error_ttl,),
+        ).rowcount
+        self._conn.commit()
+        self._conn.execute("VACUUM")
+        return deleted
+
+    def progress(self, by_domain=False):
+        """Number of cached URLs per response class, optionally per domain.
+
+        Response classes are "2XX" to "5XX", "error" and "not requested" (short-circuited URLs).
+
+        Returns:
+            df (pd.DataFrame)
+
+        """
+        group = "domain, " if by_domain else ""
+        query = f"""SELECT {group}
+                CASE
+                    WHEN error IS NOT NULL THEN 'error'
+                    WHEN response_code IS NULL THEN 'not requested'
+                    ELSE (response_code / 100) || 'XX'
+                END AS response_class,
+                COUNT(*) AS n
+            FROM expansions
+            GROUP BY {group}response_class"""
+        df = pd.read_sql_query(query, self._conn)
+        index = ["domain", "response_class"] if by_domain else ["response_class"]
+        df = df.set_index(index)["n"].unstack(fill_value=0) if by_domain else df.set_index(index)
+        if by_domain:
+            df["total"] = df.sum(axis=1)
+            df = df.sort_values("total", ascending=False)
+        return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the URL expansion cache.")
+    parser.add_argument("path", help="SQLite cache file")
+    parser.add_argument("--import-jsonl", help="import urlexpander's JSONL cache")
+    parser.add_argument("--compact", action="store_true", help="drop expired errors and VACUUM")
+    parser.add_argument("--progress", action="store_true", help="print the number of URLs per response class")
+    parser.add_argument("--by-domain", action="store_true", help="with --progress: break down per domain")
+    args = parser.parse_args()
+
+    with SqliteExpansionCache(args.path) as cache:
+        if args.import_jsonl:
+            print(f"imported {cache.import_jsonl(args.import_jsonl)} entries")
+        if args.compact:
+            print(f"deleted {cache.compact()} expired entries")
+        if args.progress:
+            pd.set_option("display.width", 200)
+            pd.set_option("display.max_rows", None)
+            print(cache.progress(by_domain=args.by_domain))
+        print(f"{cache.count()} URLs in {args.path}")
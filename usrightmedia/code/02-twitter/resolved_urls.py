@@ -0,0 +1,120 @@
+"""
+Month-partitioned store of the expanded tweeted URLs, with a watermark for incremental runs.
+
+Layout of the partition directory:
+    created_month=2016-01.pkl ... created_month=2020-12.pkl    one pickle per month of created_at
+    _watermark.json                                            last (created_at, url_id) written
+
+An incremental run of 04_expand_tweeted_urls.py only expands the rows after the
+watermark and rewrites the months those rows fall into; every other month is left
+untouched. Note that rows are selected by the watermark only: a tweet collected
+late with a created_at before the watermark is not picked up (run without
+--incremental to rebuild everything).
+
+The partitions are the authoritative copy: politicians_tweeted_urls_resolved.pkl is
+only rewritten by full runs and goes stale after an incremental one.
+
+Usage:
+    urls = load_resolved_urls()                      # all months
+    urls = load_resolved_urls(months=["2020-11"])    # selected months
+"""
+
+import glob
+import json
+import os
+
+import pandas as pd
+
+DIR_URL = os.path.join("..", "..", "data", "02-intermediate", "02-twitter")
+DIR_PARTITIONS = os.path.join(DIR_URL, "politicians_tweeted_urls_resolved")
+
+
+def _url_id_key(url_id):
+    """Sort key of a url_id ("{tweet_id}_{n}") which orders numerically, not lexically."""
+    tweet_id, n = url_id.rsplit("_", 1)
+    return int(tweet_id), int(n)
+
+
+def _partition_path(month, partition_dir):
+    return os.path.join(partition_dir, f"created_month={month}.pkl")
+
+
+def read_watermark(partition_dir=DIR_PARTITIONS):
+    """Return the watermark as {"created_at": pd.Timestamp, "url_id": str}, or None."""
+    path = os.path.join(partition_dir, "_watermark.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf8") as f:
+        watermark = json.load(f)
+    watermark["created_at"] = pd.Timestamp(watermark["created_at"])
+    return watermark
+
+
+def write_watermark(df, partition_dir=DIR_PARTITIONS):
+    """Set the watermark to the latest (created_at, url_id) row of df."""
+    if df.empty:
+        return
+    latest = df.loc[df["created_at"] == df["created_at"].max()]
+    url_id = max(latest["url_id"], key=_url_id_key)
+    path = os.path.join(partition_dir, "_watermark.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump({"created_at": latest["created_at"].iloc[0].isoformat(), "url_id": url_id}, f)
+    os.replace(tmp_path, path)
+
+
+def select_new_rows(df, watermark):
+    """Rows of df after the watermark in (created_at, url_id) order."""
+    if watermark is None:
+        return df
+    is_later = df["created_at"] > watermark["created_at"]
+    is_same_time = df["created_at"] == watermark["created_at"]
+    wm_key = _url_id_key(watermark["url_id"])
+    is_later_id = df.loc[is_same_time, "url_id"].map(lambda url_id: _url_id_key(url_id) > wm_key)
+    return df.loc[is_later | is_later_id.reindex(df.index, fill_value=False)]
+
+
+def write_partitions(df, partition_dir=DIR_PARTITIONS, append=True):
+    """Write df into its monthly partitions.
+
+    Args:
+        df (pd.DataFrame): resolved URLs with a "created_month" column
+        partition_dir (str)
+        append (bool): add the rows to existing partitions (dropping duplicate url_ids);
+                       otherwise the touched partitions are replaced
+
+    Returns:
+        months (list of str): the partitions which were written
+
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    months = []
+    for created_month, df_month in df.groupby("created_month"):
+        month = created_month.strftime("%Y-%m")
+        path = _partition_path(month, partition_dir)
+        if append and os.path.exists(path):
+            df_month = pd.concat([pd.read_pickle(path), df_month], ignore_index=True)
+            df_month = df_month.drop_duplicates(subset="url_id", keep="last")
+        tmp_path = f"{path}.tmp"
+        df_month.reset_index(drop=True).to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        months.append(month)
+    return months
+
+
+def load_resolved_urls(months=None, partition_dir=DIR_PARTITIONS):
+    """Load the expanded URLs of all (or the selected) months.
+
+    Args:
+        months (list of str, opt): months as "YYYY-MM"
+        partition_dir (str)
+
+    Returns:
+        urls (pd.DataFrame): same columns as politicians_tweeted_urls_resolved.pkl
+
+    """
+    if months is None:
+        paths = sorted(glob.glob(_partition_path("*", partition_dir)))
+    else:
+        paths = [_partition_path(month, partition_dir) for month in sorted(months)]
+    return pd.concat([pd.read_pickle(path) for path in paths], ignore_index=True)
@@ -0,0 +1,287 @@
+"""
+Asynchronous URL expansion engine for tweeted URLs.
+
+Compared to urlexpander.expand (a small fixed pool of workers per chunk):
+- many requests are in flight at once, but at most `per_domain` per host, so a
+  slow shortener only delays its own URLs instead of whole chunks
+- HEAD requests are tried first; GET (without reading the body) is only used
+  when a server doesn't answer HEAD properly
+- redirects are followed hop by hop and every hop is cached, so intermediate
+  hops shared by many links (e.g., fxn.ws, cnn.it, abcn.ws) are resolved once,
+  and concurrent requests for the same hop wait for a single request
+- URLs whose host is already the final domain of a known media outlet
+  (media_references.get_media_outlet_netloc) are returned without a network call
+- like urlexpander, URLs which end in an error are returned with a marker on the
+  host reached last: .../__CLIENT_ERROR__ (4XX/5XX) or .../__CONNECTIONPOOL_ERROR__
+  (connection errors, timeouts); 05-twitter-prep-urls-urlexpander.ipynb relies on them
+
+Usage:
+    with SqliteExpansionCache(cache_file) as cache:   # see expansion_cache.py
+        resolved_urls = expand_urls(urls, cache=cache)
+"""
+
+import asyncio
+import logging
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import aiohttp
+
+from usrightmedia.shared.media_references import get_media_outlet_netloc
+
+LOGGER = logging.getLogger("usrightmedia.url_expansion")
+
+# link shorteners and redirect services: URLs on these hosts always need to be expanded
+SHORTENER_NETLOCS = {
+    "t.co",
+    "bit.ly",
+    "ow.ly",
+    "buff.ly",
+    "dlvr.it",
+    "goo.gl",
+    "tinyurl.com",
+    "ift.tt",
+    "trib.al",
+    "fb.me",
+    "lnkd.in",
+    "tiny.cc",
+    "is.gd",
+    "amzn.to",
+    "wapo.st",
+    "nyti.ms",
+    "politi.co",
+    "hill.cm",
+    "abcn.ws",
+    "cbsn.ws",
+    "cbsloc.al",
+    "cnb.cx",
+    "cnn.it",
+    "fxn.ws",
+    "cs.pn",
+    "rdcrss.org",
+}
+
+# HEAD responses which mean "try again with GET"
+HEAD_FALLBACK_STATUSES = {400, 403, 404, 405, 501}
+
+# urlexpander's markers for URLs which couldn't be expanded
+CLIENT_ERROR = "__CLIENT_ERROR__"
+CONNECTIONPOOL_ERROR = "__CONNECTIONPOOL_ERROR__"
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
+
+
+def get_netloc(url):
+    """Lowercased host of a URL without "www." and port."""
+    try:
+        netloc = urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+    return netloc[4:] if netloc.startswith("www.") else netloc
+
+
+def normalize_url(url):
+    """Cheap normalization so trivially different copies of a URL are expanded once.
+
+    Strips whitespace, lowercases the scheme and host, and drops the fragment
+    (which is never sent to the server). Path and query are kept as-is since
+    they can be case-sensitive.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+
+def format_resolved_url(entry):
+    """resolved_url of a cache entry, with urlexpander's error marker if the expansion failed."""
+    resolved_url = entry["resolved_url"]
+    if entry.get("error"):
+        marker = CONNECTIONPOOL_ERROR
+    elif entry.get("response_code") is not None and entry["response_code"] >= 400:
+        marker = CLIENT_ERROR
+    else:
+        return resolved_url
+    if resolved_url.endswith(marker):
+        # entries imported from urlexpander's cache already carry the marker
+        return resolved_url
+    try:
+        parts = urlsplit(resolved_url)
+    except ValueError:
+        return marker
+    return f"{parts.scheme}://{parts.netloc}/{marker}"
+
+
+def get_final_netlocs():
+    """Hosts of the media outlets (and other known sites) which don't redirect any further."""
+    df_netloc = get_media_outlet_netloc(
+        include_national=True,
+        include_regional=True,
+        include_gop=True,
+        include_government=True,
+    )
+    return set(df_netloc["url_netloc"]) - SHORTENER_NETLOCS
+
+
+class _Expander:
+    """State of one expansion run (shared by all tasks of the run)."""
+
+    def __init__(self, session, cache, final_netlocs, max_redirects):
+        self.session = session
+        self.cache = cache
+        self.final_netlocs = final_netlocs
+        self.max_redirects = max_redirects
+        # hop URL -> (final URL, final status), for every hop of every redirect chain seen in this run
+        self.hops = {}
+        # hop URL -> future of its (status, location), while a request for the hop is running
+        self.inflight = {}
+        self.stats = {"short_circuit": 0, "cache": 0, "network": 0, "errors": 0}
+
+    async def _request(self, url):
+        """Return (status, location) of one hop; HEAD first, GET as fallback."""
+        try:
+            async with self.session.head(url, allow_redirects=False) as r:
+                if r.status not in HEAD_FALLBACK_STATUSES:
+                    return r.status, r.headers.get("Location")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        async with self.session.get(url, allow_redirects=False) as r:
+            # the body isn't read; only the status and Location header matter
+            return r.status, r.headers.get("Location")
+
+    async def _resolve_hop(self, url):
+        """Resolve a single hop, making sure concurrent callers share one request."""
+        if url in self.inflight:
+            return await self.inflight[url]
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[url] = future
+        try:
+            result = await self._request(url)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved in case no other caller awaits the future
+            future.exception()
+            raise
+        finally:
+            del self.inflight[url]
+
+    def _lookup(self, url):
+        """(final URL, final status) of a hop which was already resolved (in this run or a previous one)."""
+        if url in self.hops:
+            return self.hops[url]
+        entry = self.cache.get(url) if self.cache is not None else None
+        return (entry["resolved_url"], entry["response_code"]) if entry else None
+
+    async def expand(self, url):
+        """Follow the redirects of a URL; returns its cache entry."""
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached:
+            self.stats["cache"] += 1
+            return cached
+
+        chain = []
+        current = url
+        status = None
+        error = None
+        for _ in range(self.max_redirects + 1):
+            if get_netloc(current) in self.final_netlocs:
+                if not chain:
+                    self.stats["short_circuit"] += 1
+                break
+            if chain:
+                resolved = self._lookup(current)
+                if resolved is not None:
+                    current, status = resolved
+                    break
+            chain.append(current)
+            try:
+                status, location = await self._resolve_hop(current)
+                if not (300 <= status < 400 and location):
+                    break
+                # a malformed Location header (e.g., "Invalid IPv6 URL") raises ValueError
+                current = urljoin(current, location)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+
+        if chain:
+            self.stats["network"] += 1
+        if error:
+            self.stats["errors"] += 1
+
+        entry = {
+            "original_url": url,
+            "resolved_url": current,
+            "response_code": status,
+            "n_hops": len(chain),
+            "error": error,
+        }
+        if not error:
+            # every hop of the chain resolves to the same final URL
+            for n, hop in enumerate(chain):
+                self.hops[hop] = (current, status)
+                if self.cache is not None and n > 0:
+                    self.cache.set(hop, dict(entry, original_url=hop, n_hops=len(chain) - n))
+            if self.cache is not None:
+                self.cache.set(url, entry)
+        return entry
+
+
+async def _expand_all(urls, cache, concurrency, per_domain, timeout, max_redirects, max_pending):
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_domain, ttl_dns_cache=300)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout, headers={"User-Agent": USER_AGENT}
+    ) as session:
+        expander = _Expander(session, cache, get_final_netlocs(), max_redirects)
+        entries = {}
+
+        # a fixed pool of `max_pending` workers pulls from one iterator, so the number
+        # of tasks (and their memory) doesn't grow with the number of URLs
+        distinct_urls = iter(dict.fromkeys(urls))
+
+        async def worker():
+            for url in distinct_urls:
+                entries[url] = await expander.expand(url)
+                if len(entries) % 10000 == 0:
+                    LOGGER.info(f"expanded {len(entries)} URLs: {expander.stats}")
+
+        await asyncio.gather(*(worker() for _ in range(max_pending)))
+
+        LOGGER.info(f"finished expanding {len(entries)} distinct URLs: {expander.stats}")
+        return entries
+
+
+def expand_urls(
+    urls,
+    cache=None,
+    concurrency=200,
+    per_domain=8,
+    timeout=10,
+    max_redirects=10,
+    max_pending=5000,
+):
+    """Expand URLs concurrently.
+
+    Args:
+        urls (list of str)
+        cache (expansion_cache.SqliteExpansionCache, opt): cache of expanded URLs; errors aren't cached
+        concurrency (int): max. number of open connections
+        per_domain (int): max. number of open connections per host
+        timeout (float): seconds per request
+        max_redirects (int): max. number of hops followed per URL
+        max_pending (int): max. number of URLs being expanded at a time
+
+    Returns:
+        resolved_urls (list of str): aligned with urls; a URL which couldn't be expanded
+                                     resolves to the host of the last hop reached with
+                                     urlexpander's marker, e.g. http://instagram.com/__CLIENT_ERROR__
+
+    """
+    entries = asyncio.run(
+        _expand_all(urls, cache, concurrency, per_domain, timeout, max_redirects, max_pending)
+    )
+    return [format_resolved_url(entries[url]) for url in urls]
@@ -0,0 +1,52 @@
+"""
+Benchmark the per-URL overhead of scraper.scrape() vs. a reused ScraperSession.
+
+Both variants run with check_exists=True on URLs which are already stored in ES,
+so nothing is fetched and the timing is pure per-URL overhead:
+- before: scrape() constructs Inca() (config, ES client) for every URL
+- after: one ScraperSession is reused for every URL
+
+Usage:
+    python3 bench_scraper_session.py [YEAR] [N_URLS]
+"""
+
+import os
+import sys
+import time
+
+import pandas as pd
+
+from scraper import ScraperSession, find_existing_es_ids, get_es_id, scrape
+from usrightmedia.shared.loggers import get_logger
+
+YEAR = int(sys.argv[1]) if len(sys.argv) > 1 else 2016
+N_URLS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+LOGGER = get_logger(filename="04-inca-prep-bench-scraper-session", logger_type="main_file")
+
+dir_inp = os.path.join("..", "..", "data", "02-intermediate", "04-inca-prep")
+df_urls = pd.read_pickle(os.path.join(dir_inp, f"mediacloud_urls_{YEAR}.pkl"))
+
+# only benchmark URLs which are already stored so no article is (re-)fetched
+session = ScraperSession(LOGGER)
+urls = df_urls.head(N_URLS * 10).to_dict("records")
+existing = find_existing_es_ids(session.myinca, [get_es_id(d) for d in urls])
+urls = [d for d in urls if get_es_id(d) in existing][:N_URLS]
+if not urls:
+    sys.exit(f"none of the first {N_URLS * 10} URLs for {YEAR} are stored in ES yet")
+
+start = time.perf_counter()
+for url in urls:
+    scrape(url, LOGGER)
+before = (time.perf_counter() - start) / len(urls)
+
+start = time.perf_counter()
+session = ScraperSession(LOGGER)
+for url in urls:
+    session.scrape(url)
+after = (time.perf_counter() - start) / len(urls)
+
+print(f"URLs: {len(urls)}")
+print(f"per-URL overhead, scrape() with Inca() per URL: {before * 1000:.1f} ms")
+print(f"per-URL overhead, reused ScraperSession:        {after * 1000:.1f} ms")
+print(f"speed-up: {before / after:.1f}x")
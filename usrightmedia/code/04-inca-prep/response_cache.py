@@ -0,0 +1,190 @@
+"""
+Content-addressed cache of the raw HTTP responses fetched by the scrapers.
+
+Layout of the cache directory:
+    index.sqlite                      URL -> status, headers, fetch time, body hash
+    objects/ab/abcdef....gz           gzip-compressed bodies, named by their SHA-256
+
+INCA's scrapers fetch pages with `requests`, so the cache hooks in at
+requests' transport adapter (HTTPAdapter.send) for the whole process:
+- "record" mode: every response is fetched as usual and GET responses are written
+  through to the cache (entries are keyed by URL only, so a HEAD response would
+  overwrite the body of a GET)
+- "replay" mode: responses are served from the cache with zero network calls;
+  a URL which is not cached raises requests.exceptions.ConnectionError, and a HEAD
+  request gets the status and headers of the cached GET without its body
+
+Replay mode lets a changed parser in usmedia_scrapers rebuild documents at disk
+speed and offline (see scrape_runner.py --reparse). Redirects are cached per hop,
+so replaying follows the same redirect chain as the original fetch.
+
+Usage:
+    cache = ResponseCache(cache_dir)
+    with use_response_cache(cache, mode="record"):
+        session.scrape(url_info)
+"""
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+_original_send = HTTPAdapter.send
+
+
+class ResponseCache:
+    """Content-addressed store of raw HTTP responses keyed by URL.
+
+    Args:
+        cache_dir (str): directory holding the index and the compressed bodies
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        # the timeout lets several scrape processes share one cache directory
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), timeout=60, check_same_thread=False
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                status_code INTEGER,
+                reason TEXT,
+                headers TEXT,
+                final_url TEXT,
+                fetched_at REAL,
+                body_sha256 TEXT
+            )"""
+        )
+        self._conn.commit()
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], f"{digest}.gz")
+
+    def put(self, url, response):
+        """Store a requests.Response under its request URL."""
+        body = response.content or b""
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._object_path(digest)
+
+        # identical bodies (e.g., the same page under two URLs) are only stored once
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(gzip.compress(body))
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.status_code,
+                    response.reason,
+                    json.dumps(dict(response.headers)),
+                    response.url,
+                    time.time(),
+                    digest,
+                ),
+            )
+            self._conn.commit()
+
+    def get(self, url):
+        """Return the cached entry of a URL as a dict (body included), or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status_code, reason, headers, final_url, fetched_at, body_sha256 "
+                "FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        status_code, reason, headers, final_url, fetched_at, digest = row
+        with open(self._object_path(digest), "rb") as f:
+            body = gzip.decompress(f.read())
+        return {
+            "url": url,
+            "status_code": status_code,
+            "reason": reason,
+            "headers": json.loads(headers),
+            "final_url": final_url,
+            "fetched_at": fetched_at,
+            "body": body,
+        }
+
+    def has(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def _build_response(adapter, request, entry):
+    """Rebuild a requests.Response from a cache entry."""
+    response = requests.Response()
+    response.status_code = entry["status_code"]
+    response.reason = entry["reason"]
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = entry["final_url"]
+    response.request = request
+    response.connection = adapter
+    response._content = entry["body"]
+    # the body is stored decompressed; don't let requests decode it a second time
+    response.headers.pop("Content-Encoding", None)
+    return response
+
+
+@contextlib.contextmanager
+def use_response_cache(cache, mode="record"):
+    """Route every `requests` call of the process through the cache.
+
+    Args:
+        cache (ResponseCache)
+        mode (str): "record" (fetch and write through) or "replay" (cache only, offline)
+
+    """
+    if mode not in ("record", "replay"):
+        raise ValueError(f"mode must be 'record' or 'replay', got {mode}")
+
+    def send(adapter, request, **kwargs):
+        if mode == "replay":
+            entry = cache.get(request.url)
+            if entry is None:
+                raise requests.exceptions.ConnectionError(
+                    f"{request.url} is not in the response cache (replay mode)",
+                    request=request,
+                )
+            if request.method == "HEAD":
+                entry = dict(entry, body=b"")
+            return _build_response(adapter, request, entry)
+
+        response = _original_send(adapter, request, **kwargs)
+        if request.method == "GET":
+            cache.put(request.url, response)
+        return response
+
+    HTTPAdapter.send = send
+    try:
+        yield cache
+    finally:
+        HTTPAdapter.send = _original_send
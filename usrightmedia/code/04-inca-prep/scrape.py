@@ -0,0 +1,76 @@
+"""
+This script scrapes the Media Cloud URLs of one or more years.
+
+The years run concurrently under one global concurrency and rate budget (see
+scrape_runner.py); progress is journaled per year, so a crashed run resumes
+where it stopped.
+
+Examples:
+    python3 scrape.py 2016 2017 2018 2019 2020
+    python3 scrape.py 2018 --shard 1/4 --workers 32    # the 2nd of 4 shards (run the others elsewhere)
+    python3 scrape.py 2018 2019 --retry-failed          # only retry failed URLs from the journals
+    python3 scrape.py 2020 --reparse                    # rebuild documents from the response cache, offline
+"""
+
+import argparse
+
+import os
+
+from scrape_runner import DIR_CACHE, DIR_LOGS, reparse_years, run_years
+
+from usrightmedia.shared.loggers import get_logger
+
+parser = argparse.ArgumentParser(description="Scrape Media Cloud URLs with INCA.")
+parser.add_argument("years", type=int, nargs="+", help="years to scrape, e.g. 2016 2017")
+parser.add_argument("--shard", default="0/1", help="shard k/N of each year to scrape (default: 0/1)")
+parser.add_argument("--workers", type=int, default=16, help="number of concurrent fetches across all years")
+parser.add_argument("--rate", type=float, default=None, help="max. requests per second across all years")
+parser.add_argument("--max-open-years", type=int, default=2, help="number of years streamed at the same time")
+parser.add_argument(
+    "--retry-failed",
+    action="store_true",
+    help="only retry failed URLs whose backoff expired (read from the journals, not the pickles)",
+)
+parser.add_argument(
+    "--reparse",
+    action="store_true",
+    help="rebuild the documents of all cached URLs from the response cache without network calls",
+)
+parser.add_argument("--cache-dir", default=DIR_CACHE, help="response cache directory")
+parser.add_argument("--no-cache", action="store_true", help="don't write responses to the cache")
+parser.add_argument(
+    "--metrics",
+    default=None,
+    help="per-outlet metrics JSONL file (default: logs/04-inca-prep-scrape-metrics-[years]-shard[k]of[N].jsonl)",
+)
+args = parser.parse_args()
+
+years_name = "-".join(str(year) for year in args.years)
+shard_name = args.shard.replace("/", "of")
+LOGGER = get_logger(filename = f'04-inca-prep-scrape-{years_name}-shard{shard_name}', logger_type='main')
+metrics_path = args.metrics or os.path.join(
+    DIR_LOGS, f"04-inca-prep-scrape-metrics-{years_name}-shard{shard_name}.jsonl"
+)
+
+if args.reparse:
+    reparse_years(
+        args.years,
+        LOGGER,
+        cache_dir=args.cache_dir,
+        shard=args.shard,
+        n_workers=args.workers,
+        max_open_years=args.max_open_years,
+        metrics_path=metrics_path,
+    )
+else:
+    run_years(
+        args.years,
+        LOGGER,
+        shard=args.shard,
+        n_workers=args.workers,
+        rate=args.rate,
+        retry_failed=args.retry_failed,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        max_open_years=args.max_open_years,
+        metrics_path=metrics_path,
+    )
@@ -0,0 +1,302 @@
+"""
+Concurrent scraping engine built around scraper.ScraperSession.
+
+URLs are queued per outlet and a pool of worker threads, each with its own
+ScraperSession, collects them. Every outlet has its own concurrency and
+request-rate budget, timeout and retry policy (scraper.OUTLET_REGISTRY): a slow
+outlet (e.g., InfoWars) only ties up its own slots, so the other outlets keep
+going and total throughput scales with the number of workers instead of with
+the round-trip latency of a single request.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scraper import OUTLET_REGISTRY, OutletPolicy, ScraperSession, get_es_id
+from scrape_metrics import attempt_timings, install_timing_hooks
+
+# seconds before the first retry of a failed URL; doubled on every further attempt
+RETRY_BACKOFF = 30
+
+# one ScraperSession per worker thread, created when the worker starts
+_worker = threading.local()
+
+
+def _init_worker(LOGGER):
+    _worker.session = ScraperSession(LOGGER)
+    install_timing_hooks(_worker.session.myinca)
+
+
+def _scrape_in_worker(url, check_exists):
+    """Scrape a URL; exceptions are returned rather than raised so their timings are kept."""
+    with attempt_timings() as timings:
+        try:
+            status, error = _worker.session.scrape(url, check_exists=check_exists), None
+        except Exception as e:
+            status, error = "error", e
+    return status, error, timings
+
+
+class OutletBudget:
+    """Concurrency and request-rate budget of one outlet.
+
+    Only the scheduler thread reads and updates the budget, so no locking is needed.
+
+    Args:
+        concurrency (int): max. number of requests in flight
+        rate (float): max. number of requests started per second (0 or None: unlimited)
+
+    """
+
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate else 0.0
+        self.in_flight = 0
+        self.next_start = 0.0
+
+    def wait_time(self, now):
+        """Seconds until the outlet may start another request; None if all of its slots are taken."""
+        if self.in_flight >= self.concurrency:
+            return None
+        return max(0.0, self.next_start - now)
+
+    def load(self):
+        """Share of the outlet's slots which are in use."""
+        return self.in_flight / self.concurrency
+
+    def acquire(self, now):
+        self.in_flight += 1
+        self.next_start = max(now, self.next_start) + self.interval
+
+    def release(self):
+        self.in_flight -= 1
+
+
+def get_policies(outlets, overrides=None):
+    """Look up the scraper policy per outlet.
+
+    Args:
+        outlets (iterable of str): outlet names as in the Media Cloud data (e.g., "Fox News")
+        overrides (dict, opt): outlet name -> dict of OutletPolicy fields to replace,
+                               e.g. {"InfoWars": {"concurrency": 1}}
+
+    Returns:
+        dict: outlet name -> OutletPolicy
+
+    """
+    overrides = overrides or {}
+    policies = {}
+    for outlet in outlets:
+        # unknown outlets get the default policy without a scraper; scrape_concurrently() settles
+        # their URLs as "unregistered" before they are queued
+        policy = OUTLET_REGISTRY.get(outlet, OutletPolicy(scraper=None))
+        policies[outlet] = policy._replace(**overrides.get(outlet, {}))
+    return policies
+
+
+def scrape_concurrently(
+    urls,
+    LOGGER,
+    n_workers=16,
+    rate=None,
+    policies=None,
+    check_exists=True,
+    on_result=None,
+    max_buffered=1000,
+    metrics=None,
+):
+    """Collect URLs concurrently while respecting each outlet's policy.
+
+    Each outlet has a dedicated queue. Whenever a worker is free, the scheduler starts
+    a URL from the outlet which uses the smallest share of its slots (ties: the longest
+    queue first), so all workers stay busy while no outlet exceeds its budget.
+
+    Failed attempts are retried with exponential backoff up to the outlet's `retries`.
+    An attempt which runs longer than the outlet's `timeout` counts as failed; its
+    worker and outlet slot are only freed once the call returns.
+
+    URLs are pulled lazily from `urls` so that at most `max_buffered` of them wait in
+    the outlet queues at a time; a generator therefore keeps memory flat however many
+    URLs it yields. Interleave the outlets in the input (see scrape_runner.py) so the
+    buffer holds work for every outlet.
+
+    Args:
+        urls (iterable of dict): URL info as expected by ScraperSession.scrape()
+        LOGGER
+        n_workers (int): number of worker threads shared by all outlets
+        rate (float, opt): max. number of requests started per second across all outlets
+        policies (dict, opt): per-outlet policy overrides, see get_policies()
+        check_exists (bool): passed on to ScraperSession.scrape()
+        on_result (callable, opt): called from the scheduler thread as
+                                   on_result(url, status, error) once per URL with status "done",
+                                   "unregistered" or "failed",
+                                   e.g. ScrapeJournal.record_result
+        max_buffered (int): max. number of URLs read ahead from `urls`
+        metrics (ScrapeMetrics, opt): receives the outcome and timings of every attempt
+
+    Returns:
+        counts (Counter): number of "done" (of which "collected" and "skipped"), "unregistered"
+                          (no scraper for the outlet; not done), "retried", "timeout" and "failed" URLs
+
+    """
+
+    urls = iter(urls)
+    exhausted = False
+    queues = collections.OrderedDict()
+    outlet_policies = {}
+    budgets = {}
+    # the global budget only limits the request rate; n_workers limits the concurrency
+    global_budget = OutletBudget(n_workers, rate)
+    counts = collections.Counter()
+
+    def enqueue(url, attempt):
+        """Queue a URL for its outlet; returns False if it was settled right away instead."""
+        outlet = url["outlet"]
+        if outlet not in outlet_policies:
+            outlet_policies.update(get_policies([outlet], policies))
+            if outlet_policies[outlet].scraper is None:
+                LOGGER.warning(f"no scraper registered for {outlet}; its URLs are reported as unregistered")
+        policy = outlet_policies[outlet]
+        if policy.scraper is None:
+            # nothing to collect: settled without a worker or a share of the rate budget
+            counts["unregistered"] += 1
+            if metrics:
+                metrics.record_attempt(outlet, get_es_id(url), "unregistered")
+            if on_result:
+                on_result(url, "unregistered", None)
+            return False
+        if outlet not in queues:
+            queues[outlet] = collections.deque()
+            budgets[outlet] = OutletBudget(policy.concurrency, policy.rate)
+        queues[outlet].append((url, attempt))
+        return True
+
+    # future -> (outlet, url, attempt, deadline)
+    in_flight = {}
+    # attempts past their deadline which still occupy a worker: future -> outlet
+    timed_out = {}
+    # (ready time, tie-breaker, outlet, url, attempt)
+    delayed = []
+    tie_breaker = itertools.count()
+
+    def fail(outlet, url, attempt, reason, now):
+        if attempt < outlet_policies[outlet].retries:
+            counts["retried"] += 1
+            ready = now + RETRY_BACKOFF * 2 ** attempt
+            heapq.heappush(delayed, (ready, next(tie_breaker), outlet, url, attempt + 1))
+            LOGGER.info(f"retrying {url['url']} ({outlet}) in {ready - now:.0f}s: {reason}")
+        else:
+            counts["failed"] += 1
+            LOGGER.warning(f"failed to collect {url['url']} ({outlet}): {reason}")
+            if on_result:
+                on_result(url, "failed", str(reason))
+
+    LOGGER.info(f"scraping with {n_workers} workers (global rate: {rate or 'unlimited'}/s)")
+
+    with ThreadPoolExecutor(
+        max_workers=n_workers, initializer=_init_worker, initargs=(LOGGER,)
+    ) as executor:
+        while True:
+
+            # read ahead until the buffer is full
+            n_buffered = sum(len(queue) for queue in queues.values())
+            while not exhausted and n_buffered < max_buffered:
+                try:
+                    if enqueue(next(urls), 0):
+                        n_buffered += 1
+                except StopIteration:
+                    exhausted = True
+
+            if not (in_flight or delayed or n_buffered):
+                break
+
+            now = time.monotonic()
+            while delayed and delayed[0][0] <= now:
+                _, _, outlet, url, attempt = heapq.heappop(delayed)
+                enqueue(url, attempt)
+
+            # fill the free workers, least-loaded outlet first
+            next_wake = delayed[0][0] - now if delayed else None
+            while len(in_flight) + len(timed_out) < n_workers:
+                global_delay = global_budget.wait_time(now)
+                if global_delay:
+                    next_wake = global_delay if next_wake is None else min(next_wake, global_delay)
+                    break
+                candidates = []
+                for outlet, queue in queues.items():
+                    if not queue:
+                        continue
+                    delay = budgets[outlet].wait_time(now)
+                    if delay is None:
+                        continue
+                    if delay > 0:
+                        next_wake = delay if next_wake is None else min(next_wake, delay)
+                        continue
+                    candidates.append((budgets[outlet].load(), -len(queue), outlet))
+                if not candidates:
+                    break
+                _, _, outlet = min(candidates)
+                url, attempt = queues[outlet].popleft()
+                budgets[outlet].acquire(now)
+                global_budget.acquire(now)
+                future = executor.submit(_scrape_in_worker, url, check_exists)
+                in_flight[future] = (outlet, url, attempt, now + outlet_policies[outlet].timeout)
+
+            if not in_flight and not timed_out:
+                # every outlet with work left is waiting for its rate budget or a retry
+                time.sleep(next_wake or 0.01)
+                continue
+
+            if in_flight:
+                next_deadline = min(deadline for *_, deadline in in_flight.values()) - now
+                next_wake = next_deadline if next_wake is None else min(next_wake, next_deadline)
+
+            done, _ = wait(
+                list(in_flight) + list(timed_out),
+                timeout=max(next_wake, 0) if next_wake is not None else None,
+                return_when=FIRST_COMPLETED,
+            )
+            now = time.monotonic()
+
+            for future in done:
+                if future in timed_out:
+                    # the attempt was already counted as failed; only free its slot
+                    budgets[timed_out.pop(future)].release()
+                    global_budget.release()
+                    continue
+                outlet, url, attempt, _ = in_flight.pop(future)
+                budgets[outlet].release()
+                global_budget.release()
+                status, error, timings = future.result()
+                if metrics:
+                    metrics.record_attempt(outlet, get_es_id(url), status, timings)
+                if error is None and status == "unregistered":
+                    # nothing was collected: the URL is reported, but not as done
+                    counts["unregistered"] += 1
+                    if on_result:
+                        on_result(url, "unregistered", None)
+                elif error is None:
+                    counts["done"] += 1
+                    counts[status] += 1
+                    if on_result:
+                        on_result(url, "done", None)
+                else:
+                    fail(outlet, url, attempt, error, now)
+
+            for future, (outlet, url, attempt, deadline) in list(in_flight.items()):
+                if deadline <= now:
+                    del in_flight[future]
+                    timed_out[future] = outlet
+                    counts["timeout"] += 1
+                    if metrics:
+                        metrics.record_attempt(
+                            outlet, get_es_id(url), "timeout", {"total_s": outlet_policies[outlet].timeout}
+                        )
+                    fail(outlet, url, attempt, "timeout", now)
+
+    LOGGER.info(f"finished scraping: {dict(counts)}")
+    return counts
@@ -0,0 +1,167 @@
+"""
+Append-only progress journal and deterministic sharding for the scrape runs.
+
+Every finished URL is appended to a JSONL journal as one line:
+    {"es_id": ..., "status": "done" | "failed", "attempts": int,
+     "retry_after": epoch seconds or null, "error": ..., "url_info": {...}, "ts": ...}
+URLs of outlets without a registered scraper are journaled as
+    {"es_id": ..., "status": "unregistered", "ts": ...}
+and stay pending, so they are collected once the outlet is added to OUTLET_REGISTRY.
+The latest line per es_id wins. Failed lines keep the URL info, so failed URLs
+can be retried from the journal without rescanning the year's pickle.
+
+Each process writes its own file (e.g., scrape_2018_shard1of4.jsonl) into a
+per-year journal directory, but reads every file in that directory. Processes
+on different machines can therefore share the directory and resume exactly
+where they stopped, even if the number of shards changes between runs.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+from scraper import get_es_id
+
+# seconds before the first retry of a failed URL; doubled per attempt
+RETRY_BACKOFF = 15 * 60
+# failed URLs are given up on after this many attempts
+MAX_ATTEMPTS = 5
+
+
+def get_shard(es_id, n_shards):
+    """Return the shard (0 to n_shards - 1) of an es_id.
+
+    Uses a stable hash (unlike Python's built-in hash()) so every process and machine
+    assigns the same URL to the same shard.
+    """
+    digest = hashlib.md5(es_id.encode("utf-8")).hexdigest()
+    return int(digest, 16) % n_shards
+
+
+def parse_shard(shard):
+    """Parse a shard given as "k/N" (e.g., "0/4") into (k, N)."""
+    k, n = (int(x) for x in shard.split("/"))
+    if not 0 <= k < n:
+        raise ValueError(f"shard must be k/N with 0 <= k < N, got {shard}")
+    return k, n
+
+
+class ScrapeJournal:
+    """Append-only journal of the scrape outcome per es_id.
+
+    Args:
+        journal_dir (str): directory shared by all shards of a year
+        name (str): filename (without extension) this process appends to
+
+    """
+
+    def __init__(self, journal_dir, name):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.path = os.path.join(journal_dir, f"{name}.jsonl")
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        # replay every shard's journal; the latest entry per es_id wins
+        for path in glob.glob(os.path.join(journal_dir, "*.jsonl")):
+            with open(path, "r", encoding="utf8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut off by a crash
+                        continue
+                    previous = self.entries.get(entry["es_id"])
+                    if previous is None or previous["ts"] <= entry["ts"]:
+                        self.entries[entry["es_id"]] = entry
+
+        self._file = open(self.path, "a", encoding="utf8")
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _append(self, entry):
+        with self._lock:
+            self.entries[entry["es_id"]] = entry
+            self._file.write(json.dumps(entry, default=str) + "\n")
+            self._file.flush()
+
+    def record_done(self, es_id):
+        self._append({"es_id": es_id, "status": "done", "ts": time.time()})
+
+    def record_result(self, url_info, status, error=None):
+        """Record the outcome of a URL; signature matches scrape_concurrently(on_result=...)."""
+        es_id = get_es_id(url_info)
+        if status == "done":
+            self.record_done(es_id)
+            return
+        if status == "unregistered":
+            self._append({"es_id": es_id, "status": "unregistered", "ts": time.time()})
+            return
+
+        attempts = self.entries.get(es_id, {}).get("attempts", 0) + 1
+        now = time.time()
+        retry_after = (
+            now + RETRY_BACKOFF * 2 ** (attempts - 1) if attempts < MAX_ATTEMPTS else None
+        )
+        self._append(
+            {
+                "es_id": es_id,
+                "status": "failed",
+                "attempts": attempts,
+                "retry_after": retry_after,
+                "error": error,
+                "url_info": url_info,
+                "ts": now,
+            }
+        )
+
+    def is_done(self, es_id):
+        return self.entries.get(es_id, {}).get("status") == "done"
+
+    def is_pending(self, es_id, now=None):
+        """True if the es_id is neither done nor a failure waiting for (or out of) retries."""
+        entry = self.entries.get(es_id)
+        if entry is None or entry["status"] == "unregistered":
+            return True
+        if entry["status"] == "done":
+            return False
+        retry_after = entry.get("retry_after")
+        return retry_after is not None and retry_after <= (now or time.time())
+
+    def retries_due(self, shard=0, n_shards=1, now=None):
+        """URL info of the failed URLs in the shard whose backoff has expired.
+
+        Returns:
+            list of dict: URL info as expected by ScraperSession.scrape()
+
+        """
+        now = now or time.time()
+        urls = []
+        for es_id, entry in self.entries.items():
+            if entry["status"] != "failed" or get_shard(es_id, n_shards) != shard:
+                continue
+            if entry.get("retry_after") is not None and entry["retry_after"] <= now:
+                url_info = dict(entry["url_info"])
+                # publish_date was serialized as a string
+                if url_info.get("publish_date"):
+                    url_info["publish_date"] = pd.Timestamp(url_info["publish_date"])
+                urls.append(url_info)
+        return urls
+
+    def summary(self):
+        """Number of es_ids per status ("failed" includes URLs which are given up on)."""
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
@@ -0,0 +1,218 @@
+"""
+Structured per-outlet metrics for the scrape runs.
+
+Every scrape attempt is written as one JSON line:
+    {"event": "attempt", "ts": ..., "outlet": ..., "es_id": ..., "outcome": ...,
+     "total_s": ..., "fetch_s": ..., "store_s": ..., "parse_s": ...}
+- fetch_s: time spent in HTTP requests (requests.Session.send)
+- store_s: time spent in Elasticsearch calls (the INCA client's transport)
+- parse_s: the rest, i.e. time spent in INCA's parsers
+- outcome: "collected", "skipped" (already in ES), "unregistered" (no scraper for
+  the outlet), "error" or "timeout"
+
+Every `interval` seconds the engine also writes the rolling throughput:
+    {"event": "throughput", "ts": ..., "window_s": ..., "collected_per_min": ..., "outlets": {...}}
+
+Summary of a metrics file (percentiles, outcome counts, throughput):
+    python3 scrape_metrics.py ../../logs/04-inca-prep-scrape-metrics-2016-shard0of1.jsonl
+    python3 scrape_metrics.py [file] --histogram    # also print fetch latency histograms
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import pandas as pd
+import requests
+
+# per-thread accumulated seconds per kind ("fetch", "store") of the running attempt
+_timings = threading.local()
+_hooks_lock = threading.Lock()
+
+
+def _add_time(kind, seconds):
+    acc = getattr(_timings, "acc", None)
+    if acc is not None:
+        acc[kind] += seconds
+
+
+@contextlib.contextmanager
+def _timed(kind):
+    # nested calls (e.g., requests following redirects) are only counted once
+    depth = getattr(_timings, f"depth_{kind}", 0)
+    setattr(_timings, f"depth_{kind}", depth + 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(_timings, f"depth_{kind}", depth)
+        if depth == 0:
+            _add_time(kind, time.perf_counter() - start)
+
+
+def install_timing_hooks(myinca):
+    """Time HTTP requests and ES calls per thread. Safe to call more than once.
+
+    Args:
+        myinca (object): INCA instance whose ES client is timed
+
+    """
+    with _hooks_lock:
+        if not getattr(requests.Session.send, "_scrape_metrics", False):
+            original_send = requests.Session.send
+
+            def send(self, request, **kwargs):
+                with _timed("fetch"):
+                    return original_send(self, request, **kwargs)
+
+            send._scrape_metrics = True
+            requests.Session.send = send
+
+        transport = myinca.database.client.transport
+        if not getattr(transport.perform_request, "_scrape_metrics", False):
+            original_perform_request = transport.perform_request
+
+            def perform_request(*args, **kwargs):
+                with _timed("store"):
+                    return original_perform_request(*args, **kwargs)
+
+            perform_request._scrape_metrics = True
+            transport.perform_request = perform_request
+
+
+@contextlib.contextmanager
+def attempt_timings():
+    """Collect the fetch/store/parse split of the attempt running in this thread.
+
+    Yields:
+        timings (dict): filled in with "total_s", "fetch_s", "store_s" and "parse_s" on exit
+
+    """
+    timings = {}
+    _timings.acc = collections.Counter()
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        total = time.perf_counter() - start
+        acc, _timings.acc = _timings.acc, None
+        timings["total_s"] = total
+        timings["fetch_s"] = acc["fetch"]
+        timings["store_s"] = acc["store"]
+        timings["parse_s"] = max(total - acc["fetch"] - acc["store"], 0.0)
+
+
+class ScrapeMetrics:
+    """Thread-safe JSONL writer of scrape metrics.
+
+    Args:
+        path (str): JSONL file to append to
+        interval (float): seconds between rolling-throughput events
+
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self._file = open(path, "a", encoding="utf8")
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window = collections.Counter()
+
+    def close(self):
+        self.emit_throughput()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def record_attempt(self, outlet, es_id, outcome, timings=None):
+        event = {"event": "attempt", "ts": time.time(), "outlet": outlet, "es_id": es_id, "outcome": outcome}
+        event.update(timings or {})
+        self._write(event)
+        if outcome == "collected":
+            self._window[outlet] += 1
+        if time.time() - self._window_start >= self.interval:
+            self.emit_throughput()
+
+    def emit_throughput(self):
+        now = time.time()
+        window_s = now - self._window_start
+        if window_s <= 0:
+            return
+        self._write(
+            {
+                "event": "throughput",
+                "ts": now,
+                "window_s": window_s,
+                "collected_per_min": sum(self._window.values()) / window_s * 60,
+                "outlets": {o: n / window_s * 60 for o, n in self._window.items()},
+            }
+        )
+        self._window_start = now
+        self._window = collections.Counter()
+
+
+def summarize(path, histogram=False):
+    """Print per-outlet outcome counts, latency percentiles and throughput of a metrics file."""
+    with open(path, "r", encoding="utf8") as f:
+        events = [json.loads(line) for line in f]
+    df = pd.DataFrame([e for e in events if e["event"] == "attempt"])
+    if df.empty:
+        print("no attempts recorded")
+        return
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_columns", None)
+    print("OUTCOMES")
+    print(df.groupby(["outlet", "outcome"]).size().unstack(fill_value=0))
+
+    collected = df.loc[df["outcome"] == "collected"]
+    for col in ["fetch_s", "parse_s", "store_s", "total_s"]:
+        print("-" * 120)
+        print(f"{col.upper()} OF COLLECTED URLS (percentiles)")
+        print(
+            collected.groupby("outlet")[col]
+            .quantile([0.5, 0.9, 0.99])
+            .unstack()
+            .rename(columns=lambda q: f"p{int(q * 100)}")
+            .join(collected.groupby("outlet")[col].agg(["mean", "max"]))
+            .round(3)
+        )
+
+    if histogram:
+        print("-" * 120)
+        print("FETCH LATENCY HISTOGRAM OF COLLECTED URLS (seconds)")
+        buckets = [0, 0.25, 0.5, 1, 2, 5, 10, 30, float("inf")]
+        print(
+            collected.groupby(["outlet", pd.cut(collected["fetch_s"], buckets, include_lowest=True)], observed=False)
+            .size()
+            .unstack(fill_value=0)
+        )
+
+    print("-" * 120)
+    duration_min = (df["ts"].max() - df["ts"].min()) / 60
+    print("THROUGHPUT")
+    print(f"collected: {len(collected)} documents in {duration_min:.1f} minutes")
+    if duration_min > 0:
+        print(f"average: {len(collected) / duration_min:.1f} documents per minute")
+        print((collected.groupby("outlet").size() / duration_min).round(1).rename("per minute"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a scrape metrics file.")
+    parser.add_argument("path", help="metrics JSONL file")
+    parser.add_argument("--histogram", action="store_true", help="print fetch latency histograms")
+    args = parser.parse_args()
+    summarize(args.path, histogram=args.histogram)
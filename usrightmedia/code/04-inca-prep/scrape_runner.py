@@ -0,0 +1,252 @@
+"""
+Resumable, shardable scrape runs over one or more years of Media Cloud URLs.
+
+The records of each year are streamed lazily into the scraping engine: a year's
+pickle is only loaded when its turn comes, at most `max_open_years` years are
+open at a time, and the engine only reads a bounded number of URLs ahead. The
+open years share the engine's global concurrency and rate budget.
+
+See scrape.py for the command-line entry point.
+"""
+
+import collections
+import contextlib
+import datetime
+import itertools
+import os
+
+import pandas as pd
+
+from response_cache import ResponseCache, use_response_cache
+from scraper import ScraperSession, find_existing_es_ids, get_es_id
+from scrape_engine import scrape_concurrently
+from scrape_journal import ScrapeJournal, get_shard, parse_shard
+from scrape_metrics import ScrapeMetrics
+
+DIR_INP = os.path.join("..", "..", "data", "02-intermediate", "04-inca-prep")
+DIR_JOURNAL = os.path.join(DIR_INP, "journal")
+DIR_CACHE = os.path.join(DIR_INP, "response_cache")
+DIR_LOGS = os.path.join("..", "..", "logs")
+
+
+# -------------------------------------------------------------------------------------------------------------
+# streams of URL records
+
+
+def _round_robin(iterators):
+    """Yield one item from each iterator in turn until all of them are exhausted."""
+    active = collections.deque(iterators)
+    while active:
+        iterator = active.popleft()
+        try:
+            yield next(iterator)
+        except StopIteration:
+            continue
+        active.append(iterator)
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_year_records(year, shard="0/1", chunksize=500):
+    """Stream the URL records of one shard of a year, interleaved across outlets.
+
+    The pickle is only read once the generator is first advanced, and records are
+    converted to dicts `chunksize` rows at a time instead of all at once with
+    to_dict("records").
+
+    Args:
+        year (int)
+        shard (str): "k/N"; only URLs with get_shard(es_id, N) == k are yielded
+        chunksize (int): rows converted to dicts at a time per outlet
+
+    Yields:
+        dict: URL info as expected by ScraperSession.scrape()
+
+    """
+    k, n_shards = parse_shard(shard)
+    df_urls = pd.read_pickle(os.path.join(DIR_INP, f"mediacloud_urls_{year}.pkl"))
+    es_ids = df_urls["outlet"].str.replace(" ", "") + "_" + df_urls["url_id"].astype(str)
+    in_shard = [get_shard(es_id, n_shards) == k for es_id in es_ids]
+    df_urls = df_urls.loc[in_shard].reset_index(drop=True)
+
+    def outlet_records(rows):
+        for start in range(0, len(rows), chunksize):
+            yield from df_urls.iloc[rows[start : start + chunksize]].to_dict("records")
+
+    # interleave the outlets so the engine's read-ahead buffer holds work for all of them
+    outlet_rows = df_urls.groupby("outlet").indices
+    yield from _round_robin([outlet_records(rows) for rows in outlet_rows.values()])
+
+
+def _skip_collected(records, journal, myinca, LOGGER, batchsize=1000):
+    """Drop records which the journal marks as done or which already exist in ES.
+
+    Existing documents (e.g., stored before the journal existed) are journaled as done,
+    so the next run skips them without asking ES again.
+    """
+    n_skipped = 0
+    for batch in _chunked(records, batchsize):
+        batch = [url for url in batch if journal.is_pending(get_es_id(url))]
+        existing = find_existing_es_ids(myinca, [get_es_id(url) for url in batch])
+        for url in batch:
+            es_id = get_es_id(url)
+            if es_id in existing:
+                journal.record_done(es_id)
+                n_skipped += 1
+            else:
+                yield url
+    LOGGER.info(f"{journal.path}: {n_skipped} URLs were already stored in ES")
+
+
+def _open_years_lazily(years, open_year, max_open_years):
+    """Interleave the streams of the years, keeping at most max_open_years streams open."""
+    pending = collections.deque(years)
+    active = collections.deque()
+    while pending or active:
+        while pending and len(active) < max_open_years:
+            active.append(iter(open_year(pending.popleft())))
+        stream = active.popleft()
+        try:
+            yield next(stream)
+        except StopIteration:
+            continue
+        active.append(stream)
+
+
+# -------------------------------------------------------------------------------------------------------------
+# runs
+
+
+def run_years(
+    years,
+    LOGGER,
+    shard="0/1",
+    n_workers=16,
+    rate=None,
+    retry_failed=False,
+    cache_dir=DIR_CACHE,
+    max_open_years=2,
+    metrics_path=None,
+):
+    """Scrape one shard of each year, resuming from the years' journals.
+
+    Args:
+        years (list of int)
+        LOGGER
+        shard (str): "k/N"; the URLs with get_shard(es_id, N) == k are scraped
+        n_workers (int): number of concurrent fetches shared by all years and outlets
+        rate (float, opt): max. number of requests started per second across all years
+        retry_failed (bool): only retry failed URLs from the journals (the pickles aren't read)
+        cache_dir (str or None): response cache to write through to; None disables the cache
+        max_open_years (int): number of years whose records are streamed at the same time
+        metrics_path (str, opt): JSONL file for per-outlet metrics (see scrape_metrics.py)
+
+    Returns:
+        counts (Counter): see scrape_concurrently()
+
+    """
+    k, n_shards = parse_shard(shard)
+    myinca = ScraperSession(LOGGER).myinca
+
+    journals = {}
+    # id() of each URL dict handed to the engine -> journal of the year it came from
+    owners = {}
+
+    def open_year(year):
+        journal = ScrapeJournal(
+            os.path.join(DIR_JOURNAL, str(year)), f"scrape_{year}_shard{k}of{n_shards}"
+        )
+        journals[year] = journal
+        LOGGER.info(f"start {year}, shard {shard}: {datetime.datetime.now()}; journal: {journal.summary()}")
+
+        if retry_failed:
+            records = journal.retries_due(shard=k, n_shards=n_shards)
+            LOGGER.info(f"retrying {len(records)} failed URLs for {year}, shard {shard}")
+        else:
+            records = _skip_collected(iter_year_records(year, shard), journal, myinca, LOGGER)
+
+        for url in records:
+            owners[id(url)] = journal
+            yield url
+
+    def on_result(url, status, error):
+        owners.pop(id(url)).record_result(url, status, error)
+
+    response_cache = (
+        use_response_cache(ResponseCache(cache_dir), mode="record")
+        if cache_dir
+        else contextlib.nullcontext()
+    )
+
+    metrics = ScrapeMetrics(metrics_path) if metrics_path else contextlib.nullcontext()
+
+    try:
+        with response_cache, metrics:
+            counts = scrape_concurrently(
+                _open_years_lazily(years, open_year, max_open_years),
+                LOGGER,
+                n_workers=n_workers,
+                rate=rate,
+                check_exists=False,
+                on_result=on_result,
+                metrics=metrics if metrics_path else None,
+            )
+    finally:
+        for year, journal in journals.items():
+            LOGGER.info(f"journal for {year}: {journal.summary()}")
+            journal.close()
+
+    LOGGER.info(f"finished {years}, shard {shard}: {datetime.datetime.now()}")
+    return counts
+
+
+def reparse_years(
+    years,
+    LOGGER,
+    cache_dir=DIR_CACHE,
+    shard="0/1",
+    n_workers=16,
+    max_open_years=2,
+    metrics_path=None,
+):
+    """Rebuild the documents of one shard of each year from the response cache.
+
+    No network calls are made: every request is served from the cache, so this
+    runs at disk speed and works offline. The documents are stored again without
+    an existence check, i.e. the scrapers overwrite them with the new parse.
+
+    Args:
+        years (list of int)
+        LOGGER
+        cache_dir (str): response cache directory
+        shard (str): "k/N"
+        n_workers (int): number of concurrent parses
+        max_open_years (int): number of years whose records are streamed at the same time
+        metrics_path (str, opt): JSONL file for per-outlet metrics (see scrape_metrics.py)
+
+    Returns:
+        counts (Counter): see scrape_concurrently()
+
+    """
+    cache = ResponseCache(cache_dir)
+    metrics = ScrapeMetrics(metrics_path) if metrics_path else contextlib.nullcontext()
+
+    def open_year(year):
+        return (url for url in iter_year_records(year, shard) if cache.has(url["url"]))
+
+    LOGGER.info(f"re-parsing cached URLs for {years}, shard {shard}")
+    with use_response_cache(cache, mode="replay"), metrics:
+        return scrape_concurrently(
+            _open_years_lazily(years, open_year, max_open_years),
+            LOGGER,
+            n_workers=n_workers,
+            check_exists=False,
+            metrics=metrics if metrics_path else None,
+        )
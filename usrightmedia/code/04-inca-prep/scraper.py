@@ -1,93 +1,150 @@
-import os
-import pandas as pd
+import collections
 from inca import Inca
 
+from usrightmedia.shared.es_queries import query_by_ids
+
 
 # cd ~/work/home/us-right-media/usrightmedia/code/04-inca-prep
 
 
 # https://github.com/tmux/tmux/wiki/Getting-Started
-# tmux new -s scrape_2016
-# python3 scrape_2016.py &
+# tmux new -s scrape
+# python3 scrape.py 2016 2017 2018 2019 2020 &
 # To detach: the C-b d key binding is used
-# To attach: tmux attach -t scrape_2016
+# To attach: tmux attach -t scrape
 # Pressing C-b & prompts for confirmation then kills (closes) the current window. All panes in the window are killed at the same time. C-b x kills only the active pane.
 # You can use tmux kill-server to cleanly and gracefully kill all tmux open sessions (and server).
 
 
-def scrape(url_dict, LOGGER):
-    """Collect a URL using the appropriate scraper in INCA.
-    Args:
-        url_dict
-        
-        Example:
-        {'url_id': '1565840471',
-         'outlet': 'Gateway Pundit',
-         'publish_date': Timestamp('2020-04-01 17:00:59+0000', tz='UTC'),
-         'title': 'Joe Biden Appears To Be Reading From Note Cards During Media Spot (VIDEO)',
-         'url': 'https://www.thegatewaypundit.com/2020/04/joe-biden-appears-to-be-reading-from-note-cards-during-media-spot-video/',
-         'alt_url': '',
-         'ap_syndicated': False,
-         'themes': ''}
-        
-        LOGGER
-        
-    Returns:
-        None
-        *URL's info is stored as a document in Elasticsearch
-    """
-    
-    myinca = Inca()
-    
-    d = url_dict
-    url_id = d['url_id']
-    outlet = d['outlet']
-    
-    es_id = f"{outlet.replace(' ', '')}_{url_id}"
-    
-    if myinca.database.check_exists(es_id)[0]:
-        LOGGER.info(f"URL with es_id {es_id} already exists; skip.")
-    
-    else:
-        LOGGER.info(f"Collecting {es_id}...")
-        
-        if outlet == "American Renaissance":
-            myinca.usmedia_scrapers.americanrenaissance(url_info=d)
-
-        elif outlet == "Breitbart":
-            myinca.usmedia_scrapers.breitbart(url_info=d)
+# Dispatch registry: outlet name (as in the Media Cloud data) -> scraper policy.
+#   scraper: name of the scraper method in myinca.usmedia_scrapers
+#   concurrency: max. number of requests in flight for the outlet
+#   rate: max. number of requests started per second for the outlet
+#   timeout: seconds before an attempt counts as failed
+#   retries: how often a failed URL is tried again
+# Adding an outlet or throttling a fragile one only requires a change here.
+OutletPolicy = collections.namedtuple(
+    "OutletPolicy",
+    ["scraper", "concurrency", "rate", "timeout", "retries"],
+    defaults=[4, 2.0, 120, 2],
+)
+
+OUTLET_REGISTRY = {
+    "American Renaissance": OutletPolicy("americanrenaissance"),
+    "Breitbart": OutletPolicy("breitbart"),
+    "Daily Caller": OutletPolicy("dailycaller"),
+    "Daily Stormer": OutletPolicy("dailystormer", concurrency=2, rate=0.5),
+    "Fox News": OutletPolicy("foxnews"),
+    "Gateway Pundit": OutletPolicy("gatewaypundit"),
+    "InfoWars": OutletPolicy("infowars", concurrency=2, rate=0.5, timeout=300),
+    "Newsmax": OutletPolicy("newsmax"),
+    "One America News": OutletPolicy("oneamericanews"),
+    "Rush Limbaugh": OutletPolicy("rushlimbaugh"),
+    "Sean Hannity": OutletPolicy("seanhannity"),
+    "VDARE": OutletPolicy("vdare"),
+    "Washington Examiner": OutletPolicy("washingtonexaminer"),
+}
+
+
+def get_es_id(url_dict):
+    """Return the ES document ID which INCA assigns to a Media Cloud URL."""
+    return f"{url_dict['outlet'].replace(' ', '')}_{url_dict['url_id']}"
+
+
+def find_existing_es_ids(myinca, es_ids, batchsize=1000):
+    """Look up which ES document IDs are already stored, one batched request per `batchsize` IDs.
 
-        elif outlet == "Daily Caller":
-            myinca.usmedia_scrapers.dailycaller(url_info=d)
+    Args:
+        myinca (object): INCA instance
+        es_ids (list of str): ES document IDs
+        batchsize (int): IDs per request (must stay below ES's 10,000-hit window)
 
-        elif outlet == "Daily Stormer":
-            myinca.usmedia_scrapers.dailystormer(url_info=d)
+    Returns:
+        existing (set of str): the subset of es_ids which already exist in ES
 
-        elif outlet == "Fox News":
-            myinca.usmedia_scrapers.foxnews(url_info=d)
+    """
+    existing = set()
+    for start in range(0, len(es_ids), batchsize):
+        batch = es_ids[start : start + batchsize]
+        body = query_by_ids(batch)
+        body["_source"] = False
+        body["size"] = len(batch)
+        res = myinca.database.client.search(
+            index=myinca.database.elastic_index, body=body
+        )
+        existing.update(hit["_id"] for hit in res["hits"]["hits"])
+    return existing
+
+
+class ScraperSession:
+    """Long-lived scraper which owns one INCA instance.
+
+    Constructing Inca() loads INCA's config and sets up its Elasticsearch client,
+    which costs far more than checking or storing a single document. Create one
+    session per process (or per worker thread) and call scrape() for every URL;
+    the ES client keeps its pooled connections open between calls.
 
-        elif outlet == "Gateway Pundit":
-            myinca.usmedia_scrapers.gatewaypundit(url_info=d)
+    Args:
+        LOGGER
+        myinca (object, opt): existing INCA instance to reuse
 
-        elif outlet == "InfoWars":
-            myinca.usmedia_scrapers.infowars(url_info=d)
+    """
 
-        elif outlet == "Newsmax":
-            myinca.usmedia_scrapers.newsmax(url_info=d)
+    def __init__(self, LOGGER, myinca=None):
+        self.LOGGER = LOGGER
+        self.myinca = myinca or Inca()
 
-        elif outlet == "One America News":
-            myinca.usmedia_scrapers.oneamericanews(url_info=d)
+    def scrape(self, url_dict, check_exists=True):
+        """Collect a URL using the appropriate scraper in INCA.
+        Args:
+            url_dict
+            
+            Example:
+            {'url_id': '1565840471',
+             'outlet': 'Gateway Pundit',
+             'publish_date': Timestamp('2020-04-01 17:00:59+0000', tz='UTC'),
+             'title': 'Joe Biden Appears To Be Reading From Note Cards During Media Spot (VIDEO)',
+             'url': 'https://www.thegatewaypundit.com/2020/04/joe-biden-appears-to-be-reading-from-note-cards-during-media-spot-video/',
+             'alt_url': '',
+             'ap_syndicated': False,
+             'themes': ''}
+
+            check_exists (bool): check ES for the document before fetching;
+                                 set to False if the URLs were already checked with find_existing_es_ids()
+            
+        Returns:
+            status (str): "collected", "skipped" (already in ES) or "unregistered" (no scraper for the outlet)
+            *URL's info is stored as a document in Elasticsearch
+        """
+        
+        myinca = self.myinca
+        LOGGER = self.LOGGER
+        
+        d = url_dict
+        outlet = d['outlet']
+        
+        es_id = get_es_id(d)
+        
+        if check_exists and myinca.database.check_exists(es_id)[0]:
+            LOGGER.info(f"URL with es_id {es_id} already exists; skip.")
+            return "skipped"
+        
+        elif outlet not in OUTLET_REGISTRY:
+            LOGGER.warning(f"No scraper registered for outlet {outlet}; skip {es_id}.")
+            return "unregistered"
 
-        elif outlet == "Rush Limbaugh":
-            myinca.usmedia_scrapers.rushlimbaugh(url_info=d)
+        else:
+            LOGGER.info(f"Collecting {es_id}...")
+            scraper = getattr(myinca.usmedia_scrapers, OUTLET_REGISTRY[outlet].scraper)
+            scraper(url_info=d)
+            LOGGER.info(f"Finished collecting {es_id}.")
+            return "collected"
 
-        elif outlet == "Sean Hannity":
-            myinca.usmedia_scrapers.seanhannity(url_info=d)
 
-        elif outlet == "VDARE":
-            myinca.usmedia_scrapers.vdare(url_info=d)
+def scrape(url_dict, LOGGER, check_exists=True):
+    """Collect a single URL with a throwaway ScraperSession.
 
-        elif outlet == "Washington Examiner":
-            myinca.usmedia_scrapers.washingtonexaminer(url_info=d)
-            
-        LOGGER.info(f"Finished collecting {es_id}.")
\ No newline at end of file
+    Kept for one-off calls; use a ScraperSession when collecting many URLs.
+    See ScraperSession.scrape() for the arguments.
+    """
+    return ScraperSession(LOGGER).scrape(url_dict, check_exists=check_exists)
@@ -0,0 +1,77 @@
+"""
+Benchmark the multi-process text cleaning (shared/text_cleaning.py) in documents per second per core.
+
+A random sample of outlet documents is read from ES once; only the cleaning is timed
+(no ES reads or writes):
+- serial: every step applied in one process
+- parallel: batches fanned out to a process pool, for 1, 2, 4, ... processes
+
+The pool uses the same start method as text_cleaning.iter_cleaned_parallel (a fork server).
+
+Usage:
+    python3 bench_text_cleaning.py [N_DOCS] [MAX_PROCESSES]
+"""
+
+import collections
+import concurrent.futures
+import os
+import sys
+import time
+
+from inca import Inca
+
+from usrightmedia.shared.corpus_snapshot import OUTLET_DOCTYPES
+from usrightmedia.shared.es_queries import query_doctypes, sample_by_query
+from usrightmedia.shared.text_cleaning import clean_batch, get_mp_context
+
+N_DOCS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+MAX_PROCESSES = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+BATCHSIZE = 500
+
+
+def main():
+    myinca = Inca()
+    hits = sample_by_query(
+        myinca,
+        query_doctypes(OUTLET_DOCTYPES, source_includes=["doctype", "article_maintext"]),
+        n=N_DOCS,
+        seed=42,
+    )
+    texts = collections.defaultdict(list)
+    for hit in hits:
+        if hit["_source"].get("article_maintext"):
+            texts[hit["_source"]["doctype"]].append((hit["_id"], hit["_source"]["article_maintext"]))
+    batches = [
+        (doctype, docs[start : start + BATCHSIZE])
+        for doctype, docs in texts.items()
+        for start in range(0, len(docs), BATCHSIZE)
+    ]
+    n_docs = sum(len(batch) for _, batch in batches)
+    if not n_docs:
+        sys.exit("no documents with article_maintext in the sample")
+
+    start = time.perf_counter()
+    for doctype, batch in batches:
+        clean_batch(doctype, batch)
+    serial = n_docs / (time.perf_counter() - start)
+
+    print(f"documents: {n_docs} (batches of {BATCHSIZE})")
+    print(f"serial:       {serial:8.0f} docs/s")
+
+    n_processes = 1
+    while n_processes <= MAX_PROCESSES:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes, mp_context=get_mp_context()) as executor:
+            # warm up the workers (imports, stopwords, compiled rules) before timing
+            list(executor.map(clean_batch, *zip(*[(doctype, batch[:1]) for doctype, batch in batches])))
+            start = time.perf_counter()
+            list(executor.map(clean_batch, *zip(*batches)))
+            rate = n_docs / (time.perf_counter() - start)
+        print(
+            f"{n_processes:3d} processes: {rate:8.0f} docs/s, {rate / n_processes:8.0f} docs/s per core "
+            f"(speed-up {rate / serial:.1f}x)"
+        )
+        n_processes *= 2
+
+
+if __name__ == "__main__":
+    main()
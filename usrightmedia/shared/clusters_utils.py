@@ -27,12 +27,9 @@ LOGGER = logging.getLogger("clusters_utils")
 
 import pandas as pd
 
-# For retrieving topic assignments and (re-)tweets
-from inca import Inca
-
-myinca = Inca()
-
-from usrightmedia.shared.es_queries import query_by_ids
+from usrightmedia.shared.corpus_snapshot import read_fields_for_ids
+from usrightmedia.shared.es_queries import fetch_by_ids
+from usrightmedia.shared.field_cache import FieldCache
 from usrightmedia.shared.media_references import get_media_outlet_ideo
 
 df_ideo = get_media_outlet_ideo()
@@ -45,6 +42,20 @@ EST_RIGHT_DOCTYPES = list(
 )
 IDEOS = {"established right": "est", "alternative right": "alt"}
 
+# For retrieving topic assignments and (re-)tweets; created on first use,
+# so the module can be imported (and used with a snapshot) without ES
+_myinca = None
+
+
+def get_inca():
+    """Return the shared INCA instance."""
+    global _myinca
+    if _myinca is None:
+        from inca import Inca
+
+        _myinca = Inca()
+    return _myinca
+
 # =============================================================================================================
 # DATA: CLUSTERS
 
@@ -122,12 +133,14 @@ def get_doc_topic(doc_id):
     return topic
 
 
-def get_field_value_for_ids(doc_ids, field="tweets2_url_ids"):
+def get_field_value_for_ids(doc_ids, field="tweets2_url_ids", cache_dir=None, snapshot_dir=None):
     """Return the field value for a list of doc_ids.
 
     Args:
         doc_ids (list of str): list of document IDs ("_id" in ES)
         field (str): document field to retrieve from ES
+        cache_dir (str, opt): FieldCache directory; only new or updated documents are fetched from ES
+        snapshot_dir (str, opt): corpus snapshot to read from instead of ES (see corpus_snapshot.py)
 
     Returns:
         df (dataframe): row index values are the doc_ids
@@ -135,13 +148,19 @@ def get_field_value_for_ids(doc_ids, field="tweets2_url_ids"):
 
     """
 
-    # initialize dataframe to populate
-    df = pd.DataFrame(index=doc_ids)
-    df[field] = [[] for _ in range(len(df))]
+    if snapshot_dir:
+        values = read_fields_for_ids(snapshot_dir, doc_ids, [field])[field].dropna().to_dict()
+    elif cache_dir:
+        values = FieldCache(cache_dir, get_inca()).get(doc_ids, [field])[field].dropna().to_dict()
+    else:
+        # fetch only the field, in concurrent batches of IDs
+        values = {
+            doc["_id"]: doc.get("_source", {}).get(field, [])
+            for doc in fetch_by_ids(get_inca(), doc_ids, fields=[field])
+        }
 
-    # use scroll query because ES returns at most 10,000 docs per window
-    for doc in myinca.database.scroll_query(query_by_ids(doc_ids)):
-        df.at[doc["_id"], field] = doc["_source"][field]
+    df = pd.DataFrame(index=doc_ids)
+    df[field] = [values.get(doc_id, []) for doc_id in doc_ids]
 
     return df
 
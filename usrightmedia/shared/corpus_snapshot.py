@@ -0,0 +1,233 @@
+"""Contains an offline, columnar snapshot of the INCA corpus.
+
+export_snapshot() reads the 13 outlet doctypes plus tweets2 and tweets2_url from ES
+(with the parallel scan in es_scan.py) and writes the analysis fields only, as
+Parquet files partitioned by doctype and year:
+
+    snapshot_dir/
+        _snapshot.json                      export time, fields and document counts
+        doctype=foxnews/year=2016/part-00000.parquet
+        ...
+        doctype=tweets2_url/year=2020/part-00000.parquet
+
+The read API only touches the partitions (and columns) it needs, so analysis runs at
+local disk speed, without ES, and against a frozen snapshot:
+
+    from usrightmedia.shared.corpus_snapshot import read_snapshot, read_fields_for_ids
+
+    df = read_snapshot(snapshot_dir, doctypes=["foxnews"], years=[2020], columns=["title", "publish_date"])
+    df_tw = read_fields_for_ids(snapshot_dir, list(df_clusters["doc_id"]), ["tweets2_url_ids"])
+
+Nested fields (e.g., author.username in tweets2) are flattened into dotted column names.
+
+"""
+import datetime
+import glob
+import json
+import logging
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from usrightmedia.shared.es_queries import query_doctypes
+from usrightmedia.shared.es_scan import scan
+from usrightmedia.shared.media_references import get_media_outlet_ideo
+
+LOGGER = logging.getLogger("corpus_snapshot")
+
+_df_ideo = get_media_outlet_ideo()
+OUTLET_DOCTYPES = sorted(_df_ideo.loc[_df_ideo["ideo_category"] == "right"]["outlet_std"])
+TWITTER_DOCTYPES = ["tweets2", "tweets2_url"]
+
+# `_source` fields kept per doctype (wildcards are allowed)
+OUTLET_FIELDS = [
+    "doctype",
+    "publish_date",
+    "title",
+    "url",
+    "resolved_url",
+    "standardized_url",
+    "tweets2_url_ids",
+    "lda_tfidf_texts_*",
+]
+SNAPSHOT_FIELDS = {
+    "tweets2": ["doctype", "id", "created_at", "author_id", "author.username", "text"],
+    "tweets2_url": [
+        "doctype",
+        "tweet_id",
+        "created_at",
+        "author_id",
+        "username",
+        "url_id",
+        "resolved_url",
+        "standardized_url",
+    ],
+}
+DATE_FIELDS = {"tweets2": "created_at", "tweets2_url": "created_at"}
+
+
+def get_snapshot_fields(doctype):
+    return SNAPSHOT_FIELDS.get(doctype, OUTLET_FIELDS)
+
+
+def get_date_field(doctype):
+    return DATE_FIELDS.get(doctype, "publish_date")
+
+
+def _table_to_pandas(table):
+    df = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type):
+            # Arrow returns lists as numpy arrays; keep them as lists like in ES `_source`
+            df[field.name] = [v.tolist() if v is not None else None for v in df[field.name]]
+    return df
+
+
+def _partition_dir(snapshot_dir, doctype, year):
+    return os.path.join(snapshot_dir, f"doctype={doctype}", f"year={year}")
+
+
+def _flush(snapshot_dir, doctype, year, frames, n_files):
+    """Write the buffered rows of one partition into a new part file."""
+    df = pd.concat(frames, ignore_index=True)
+    partition_dir = _partition_dir(snapshot_dir, doctype, year)
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, f"part-{n_files:05d}.parquet")
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+
+
+def export_doctype(myinca, snapshot_dir, doctype, n_slices=4, batchsize=1000, rows_per_file=100000):
+    """Export one doctype to its partitions.
+
+    Returns:
+        counts (dict): year -> number of documents
+
+    """
+    date_field = get_date_field(doctype)
+    query = query_doctypes([doctype], source_includes=get_snapshot_fields(doctype))
+
+    buffers = {}
+    n_buffered = {}
+    n_files = {}
+    counts = {}
+    for hits in scan(myinca, query, n_slices=n_slices, batchsize=batchsize):
+        df = pd.json_normalize([hit.get("_source", {}) for hit in hits])
+        df.insert(0, "_id", [hit["_id"] for hit in hits])
+        # a page in which no document has the date field has no such column
+        dates = df[date_field] if date_field in df.columns else pd.Series(pd.NaT, index=df.index)
+        years = pd.to_datetime(dates, utc=True, errors="coerce", format="ISO8601").dt.year
+        # documents without a (valid) date go into year=0
+        for year, df_year in df.groupby(years.fillna(0).astype(int)):
+            buffers.setdefault(year, []).append(df_year)
+            n_buffered[year] = n_buffered.get(year, 0) + len(df_year)
+            counts[year] = counts.get(year, 0) + len(df_year)
+            if n_buffered[year] >= rows_per_file:
+                _flush(snapshot_dir, doctype, year, buffers.pop(year), n_files.get(year, 0))
+                n_files[year] = n_files.get(year, 0) + 1
+                n_buffered[year] = 0
+
+    for year, frames in buffers.items():
+        _flush(snapshot_dir, doctype, year, frames, n_files.get(year, 0))
+
+    LOGGER.info(f"exported {sum(counts.values())} {doctype} documents")
+    return counts
+
+
+def export_snapshot(myinca, snapshot_dir, doctypes=None, n_slices=4, batchsize=1000, rows_per_file=100000):
+    """Export the analysis fields of the corpus to Parquet, partitioned by doctype and year.
+
+    Args:
+        myinca (object): INCA instance
+        snapshot_dir (str): new (or empty) directory
+        doctypes (list, opt): defaults to OUTLET_DOCTYPES + TWITTER_DOCTYPES
+        n_slices (int): parallel slices per doctype scan
+        batchsize (int): documents per scroll page
+        rows_per_file (int): max. rows per Parquet file
+
+    Returns:
+        counts (dict): doctype -> year -> number of documents
+
+    """
+    if glob.glob(os.path.join(snapshot_dir, "doctype=*")):
+        raise FileExistsError(f"{snapshot_dir} already holds a snapshot")
+    os.makedirs(snapshot_dir, exist_ok=True)
+    doctypes = doctypes or OUTLET_DOCTYPES + TWITTER_DOCTYPES
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    counts = {
+        doctype: export_doctype(myinca, snapshot_dir, doctype, n_slices, batchsize, rows_per_file)
+        for doctype in doctypes
+    }
+
+    # written last: a snapshot without _snapshot.json is incomplete
+    with open(os.path.join(snapshot_dir, "_snapshot.json"), "w", encoding="utf8") as f:
+        json.dump(
+            {
+                "started_at": started_at,
+                "index": myinca.database.elastic_index,
+                "fields": {doctype: get_snapshot_fields(doctype) for doctype in doctypes},
+                "counts": counts,
+            },
+            f,
+            indent=2,
+        )
+    return counts
+
+
+def read_snapshot_info(snapshot_dir):
+    path = os.path.join(snapshot_dir, "_snapshot.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{snapshot_dir} is not a complete snapshot (no _snapshot.json)")
+    with open(path, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def read_snapshot(snapshot_dir, doctypes, years=None, columns=None):
+    """Read documents from a snapshot.
+
+    Args:
+        snapshot_dir (str)
+        doctypes (list)
+        years (list of int, opt): all years if None
+        columns (list, opt): columns besides "_id"; all columns if None
+
+    Returns:
+        df (pd.DataFrame): one row per document with an "_id" column
+
+    """
+    read_snapshot_info(snapshot_dir)
+    year_glob = "*" if years is None else "{}"
+    paths = []
+    for doctype in doctypes:
+        for year in [None] if years is None else years:
+            partition_dir = _partition_dir(snapshot_dir, doctype, year_glob.format(year))
+            paths.extend(sorted(glob.glob(os.path.join(partition_dir, "*.parquet"))))
+
+    frames = []
+    for path in paths:
+        if columns is None:
+            frames.append(_table_to_pandas(pq.read_table(path)))
+        else:
+            # a part file only has the columns which occurred in its documents
+            available = set(pq.read_schema(path).names)
+            df = _table_to_pandas(pq.read_table(path, columns=["_id"] + [c for c in columns if c in available]))
+            frames.append(df.reindex(columns=["_id"] + list(columns)))
+    if not frames:
+        return pd.DataFrame(columns=["_id"] + list(columns or []))
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_fields_for_ids(snapshot_dir, doc_ids, fields):
+    """Read fields of outlet documents by doc_id (e.g., "FoxNews_587764050").
+
+    Only the partitions of the doctypes in the doc_ids are read.
+
+    Returns:
+        df (pd.DataFrame): index is the doc_ids found in the snapshot; one column per field
+
+    """
+    doctypes = sorted({doc_id[0 : doc_id.find("_")].lower() for doc_id in doc_ids})
+    df = read_snapshot(snapshot_dir, doctypes, columns=fields)
+    return df.loc[df["_id"].isin(set(doc_ids))].set_index("_id")
@@ -1,8 +1,60 @@
-def query_tw_author_id(author_id):
+import concurrent.futures
+import itertools
+
+# ES rejects terms queries with more than 65,536 terms (index.max_terms_count)
+# and searches which return more than 10,000 hits (index.max_result_window)
+MAX_IDS_PER_REQUEST = 10000
+
+
+def request_options(
+    body,
+    source_includes=None,
+    source_excludes=None,
+    size=None,
+    sort=None,
+    docvalue_fields=None,
+):
+    """Add request options to an ES query body.
+
+    Only the options which are given are added, so a builder called without
+    options still returns a bare query (and the full `_source`).
+
+    Args:
+        body (dict): ES query body; modified in place
+        source_includes (list or False, opt): `_source` fields to return; False returns no `_source`
+        source_excludes (list, opt): `_source` fields to leave out (e.g., "article_maintext*")
+        size (int, opt): number of hits (per page when scrolling)
+        sort (list, opt): e.g., ["_doc"] or [{"publish_date": "asc"}]
+        docvalue_fields (list, opt): fields to return from doc values instead of `_source`
+
+    Returns:
+        body (dict): ES query body
+
+    """
+    source = {}
+    if source_includes is False:
+        body["_source"] = False
+    elif source_includes is not None:
+        source["includes"] = source_includes
+    if source_excludes is not None:
+        source["excludes"] = source_excludes
+    if source:
+        body["_source"] = source
+    if size is not None:
+        body["size"] = size
+    if sort is not None:
+        body["sort"] = sort
+    if docvalue_fields is not None:
+        body["docvalue_fields"] = docvalue_fields
+    return body
+
+
+def query_tw_author_id(author_id, **options):
     """ES query by Twitter's author_id
 
     Args:
         author_id (str)
+        **options: request options, see request_options()
 
     Returns:
         ES query (JSON)
@@ -11,107 +63,261 @@ def query_tw_author_id(author_id):
         INCA
 
     """
-    return {
-        "query": {
-            "bool": {
-                "filter": [
-                    {"term": {"doctype": "tweets2"}},
-                    {"match": {"author_id": author_id}},
-                ]
+    return request_options(
+        {
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"doctype": "tweets2"}},
+                        {"match": {"author_id": author_id}},
+                    ]
+                }
             }
-        }
-    }
+        },
+        **options,
+    )
 
 
-def query_tw_username(username):
+def query_tw_username(username, **options):
     """ES query by Twitter's author.username
 
     Args:
         username (str)
+        **options: request options, see request_options()
 
     Returns:
         ES query (JSON)
 
     """
-    return {
-        "query": {
-            "bool": {
-                "filter": [
-                    {"term": {"doctype": "tweets2"}},
-                    {"match": {"author.username": username}},
-                ]
+    return request_options(
+        {
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"doctype": "tweets2"}},
+                        {"match": {"author.username": username}},
+                    ]
+                }
             }
-        }
-    }
+        },
+        **options,
+    )
 
 
-def query_tw_field_exists(field):
+def query_tw_field_exists(field, **options):
     """ES query within documents pulled from Twitter API v2
 
     Args:
         field (str)
+        **options: request options, see request_options()
 
     Returns:
         ES query (JSON)
 
     """
 
-    return {
-        "query": {
-            "bool": {
-                "filter": [
-                    {"term": {"doctype": "tweets2"}},
-                    {"exists": {"field": field}},
-                ]
+    return request_options(
+        {
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"doctype": "tweets2"}},
+                        {"exists": {"field": field}},
+                    ]
+                }
             }
-        }
-    }
+        },
+        **options,
+    )
 
 
-def query_doctypes(doctypes):
+def query_doctypes(doctypes, **options):
     """ES query for specified doctypes
 
     Args:
         doctypes (list)
+        **options: request options, see request_options()
 
     Returns:
         ES query (JSON)
 
     """
-    return {"query": {"terms": {"doctype": doctypes}}}
+    return request_options({"query": {"terms": {"doctype": doctypes}}}, **options)
+
+
+def query_random_sample(query, n=5, seed=None):
+    """Wrap an ES query so its hits come back in random order.
+
+    Args:
+        query (dict): ES query body; request options (e.g., `_source`) are kept
+        n (int): number of hits
+        seed (int, opt): same seed, same sample (as long as the index doesn't change);
+                         None draws a new sample every time
+
+    Returns:
+        ES query (JSON)
+
+    """
+    random_score = {} if seed is None else {"seed": seed, "field": "_seq_no"}
+    body = {key: value for key, value in query.items() if key not in ("query", "sort")}
+    body["query"] = {
+        "function_score": {
+            "query": query.get("query", {"match_all": {}}),
+            "random_score": random_score,
+            "boost_mode": "replace",
+        }
+    }
+    body["size"] = n
+    return body
+
+
+def sample_by_query(myinca, query, n=5, seed=None):
+    """Random sample of the docs matching a query, with one search request (no scroll).
+
+    Args:
+        myinca (object): INCA instance
+        query (dict): elasticsearch query
+        n (int): sample size (at most 10,000)
+        seed (int, opt): for a reproducible sample
+
+    Returns:
+        list of documents (dict)
+
+    """
+    res = myinca.database.client.search(
+        index=myinca.database.elastic_index, body=query_random_sample(query, n=n, seed=seed)
+    )
+    return res["hits"]["hits"]
+
+
+def stratified_sample_by_query(
+    myinca, query, doctypes, years, n_per_stratum=2, seed=None, date_field="publish_date"
+):
+    """Random sample of the docs matching a query per doctype and year, with one msearch request.
 
+    Args:
+        myinca (object): INCA instance
+        query (dict): elasticsearch query
+        doctypes (list): e.g., DOCTYPES in clusters_utils
+        years (list of int)
+        n_per_stratum (int): sample size per doctype and year
+        seed (int, opt): for a reproducible sample
+        date_field (str): date field which defines the year
 
-def spot_check_by_query(myinca, query, n_examples=5):
+    Returns:
+        samples (dict): (doctype, year) -> list of documents (dict)
+
+    """
+    strata = [(doctype, year) for doctype in doctypes for year in years]
+    searches = []
+    for doctype, year in strata:
+        stratum_query = dict(query)
+        stratum_query["query"] = {
+            "bool": {
+                "filter": [
+                    query.get("query", {"match_all": {}}),
+                    {"term": {"doctype": doctype}},
+                    {"range": {date_field: {"gte": f"{year}-01-01", "lt": f"{year + 1}-01-01"}}},
+                ]
+            }
+        }
+        searches.append({"index": myinca.database.elastic_index})
+        searches.append(query_random_sample(stratum_query, n=n_per_stratum, seed=seed))
+
+    res = myinca.database.client.msearch(body=searches)
+    return {
+        stratum: response.get("hits", {}).get("hits", [])
+        for stratum, response in zip(strata, res["responses"])
+    }
+
+
+def spot_check_by_query(myinca, query, n_examples=5, seed=None, random=True):
     """Spot-check a sample of docs.
 
     Args:
         myinca (object): INCA instance
         query (dict): elasticsearch query
         n_examples (int): number of examples to return
+        seed (int, opt): for a reproducible sample
+        random (bool): random sample of all matching docs; otherwise the first docs of the index
 
     Returns:
         list of documents (dict)
 
     """
-    generator = myinca.database.document_generator(query=query)
-
-    docs = []
-    for n, doc in enumerate(generator):
-        if n >= n_examples:
-            break
-        docs.append(doc)
-    return docs
+    if random:
+        return sample_by_query(myinca, query, n=n_examples, seed=seed)
+    body = dict(query, size=n_examples)
+    res = myinca.database.client.search(index=myinca.database.elastic_index, body=body)
+    return res["hits"]["hits"]
 
 
-def query_by_ids(ids):
+def query_by_ids(ids, **options):
     """Get documents from ES based on specified ID.
 
     Args:
         ids (list): selected IDs
-        fields (list): selected fields
+        **options: request options, see request_options()
 
     Returns:
         search_params (dict): ES query
     """
     search_params = {"query": {"terms": {"_id": ids}}}
-    return search_params
+    return request_options(search_params, **options)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _search_ids(myinca, ids, fields, version):
+    body = query_by_ids(ids, source_includes=fields, size=len(ids))
+    if version:
+        body["version"] = True
+    res = myinca.database.client.search(index=myinca.database.elastic_index, body=body)
+    return res["hits"]["hits"]
+
+
+def fetch_by_ids(myinca, ids, fields=None, batchsize=1000, n_workers=4, version=False):
+    """Get documents from ES by ID in concurrent batches.
+
+    Each batch is one sized `terms` search (no scroll context), so a long list of IDs
+    never turns into one huge request body. The batches share the ES client's
+    connection pool.
+
+    Args:
+        myinca (object): INCA instance
+        ids (iterable of str): selected IDs; duplicates are fetched once
+        fields (list or False, opt): `_source` fields to return; None returns the full `_source`,
+                                     False none (e.g., to check which IDs exist)
+        batchsize (int): IDs per request (at most MAX_IDS_PER_REQUEST)
+        n_workers (int): number of concurrent requests
+        version (bool): include each document's "_version" in its hit
+
+    Yields:
+        doc (dict): ES hit with "_id" and "_source"; in order of completion, not of ids.
+                    IDs which don't exist are skipped.
+
+    """
+    batchsize = min(batchsize, MAX_IDS_PER_REQUEST)
+    batches = _batches(dict.fromkeys(ids), batchsize)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # keep a bounded number of batches in flight so results stream out as they arrive
+        pending = {
+            executor.submit(_search_ids, myinca, batch, fields, version)
+            for batch in itertools.islice(batches, n_workers * 2)
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for batch in itertools.islice(batches, len(done)):
+                pending.add(executor.submit(_search_ids, myinca, batch, fields, version))
+            for future in done:
+                yield from future.result()
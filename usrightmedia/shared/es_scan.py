@@ -0,0 +1,144 @@
+"""Contains a parallel scan of the INCA index with sliced scrolls.
+
+INCA's document_generator / doctype_generator / scroll_query read through one
+scroll cursor. scan() splits the scroll into `n_slices` independent slices
+(https://www.elastic.co/guide/en/elasticsearch/reference/6.8/search-request-scroll.html#sliced-scroll),
+reads them in parallel threads and yields the merged batches as they arrive:
+
+    from usrightmedia.shared.es_queries import query_doctypes
+    from usrightmedia.shared.es_scan import scan
+
+    query = query_doctypes(["foxnews"], source_includes=["title", "publish_date"])
+    for df in scan(myinca, query, output="dataframe"):
+        ...
+
+Request options (`_source` includes/excludes, size, sort, docvalue_fields) are
+taken from the query body built by es_queries, or can be passed to scan() directly.
+
+Batches come out in no particular order. A good number of slices is the number
+of shards of the index (or a multiple of it), since each slice is served by one shard.
+
+"""
+import logging
+import queue
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+from usrightmedia.shared.es_queries import request_options
+
+LOGGER = logging.getLogger("es_scan")
+
+OUTPUTS = ("hits", "dataframe", "arrow")
+
+
+def _to_output(hits, output):
+    if output == "hits":
+        return hits
+    # docvalue_fields come back under "fields"
+    rows = [dict(hit.get("_source", {}), **hit.get("fields", {}), _id=hit["_id"]) for hit in hits]
+    df = pd.DataFrame(rows)
+    if output == "dataframe":
+        return df
+    # via pandas, the columns are the union of the fields of all hits (from_pylist only uses the first row)
+    return pa.RecordBatch.from_pandas(df, preserve_index=False)
+
+
+def _scan_slice(myinca, query, slice_id, n_slices, batchsize, scroll, out, stop):
+    """Read one slice of a scroll into the `out` queue; ends with a None sentinel."""
+    client = myinca.database.client
+    body = dict(query)
+    if n_slices > 1:
+        body["slice"] = {"id": slice_id, "max": n_slices}
+    body.setdefault("size", batchsize)
+    # scroll in index order: the cheapest order when the sort order doesn't matter
+    body.setdefault("sort", ["_doc"])
+
+    scroll_id = None
+    try:
+        res = client.search(index=myinca.database.elastic_index, body=body, scroll=scroll)
+        while not stop.is_set():
+            scroll_id = res.get("_scroll_id")
+            hits = res["hits"]["hits"]
+            if not hits:
+                break
+            out.put(hits)
+            res = client.scroll(scroll_id=scroll_id, scroll=scroll)
+    except Exception as e:
+        out.put(e)
+    finally:
+        if scroll_id:
+            try:
+                client.clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                LOGGER.debug(f"could not clear the scroll of slice {slice_id}")
+        out.put(None)
+
+
+def scan(
+    myinca,
+    query,
+    n_slices=4,
+    batchsize=1000,
+    scroll="5m",
+    output="hits",
+    max_buffered=None,
+    **options,
+):
+    """Scan all documents matching a query with a sliced scroll.
+
+    Args:
+        myinca (object): INCA instance
+        query (dict): ES query body (e.g., from es_queries)
+        n_slices (int): number of slices read in parallel
+        batchsize (int): documents per scroll page per slice, unless the query sets "size"
+        scroll (str): how long ES keeps each scroll context alive between pages
+        output (str): "hits" (list of ES hits), "dataframe" (pd.DataFrame of `_source` and
+                      docvalue fields with an "_id" column) or "arrow" (pa.RecordBatch, same columns)
+        max_buffered (int, opt): pages held in memory before the slices wait for the
+                                 consumer; defaults to 2 * n_slices
+        **options: request options overriding those of the query, see es_queries.request_options()
+
+    Yields:
+        batch: one page of one slice, in the format given by `output`
+
+    """
+    if output not in OUTPUTS:
+        raise ValueError(f"output must be one of {OUTPUTS}, got {output}")
+    query = request_options(dict(query), **options)
+
+    out = queue.Queue(maxsize=max_buffered or 2 * n_slices)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_scan_slice,
+            args=(myinca, query, slice_id, n_slices, batchsize, scroll, out, stop),
+            daemon=True,
+        )
+        for slice_id in range(n_slices)
+    ]
+    for thread in threads:
+        thread.start()
+
+    n_running = n_slices
+    n_docs = 0
+    try:
+        while n_running:
+            item = out.get()
+            if item is None:
+                n_running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                n_docs += len(item)
+                yield _to_output(item, output)
+    finally:
+        # the consumer stopped early or a slice failed: let the other slices finish
+        stop.set()
+        while any(thread.is_alive() for thread in threads):
+            try:
+                out.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        LOGGER.info(f"scanned {n_docs} documents in {n_slices} slices")
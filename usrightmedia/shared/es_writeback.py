@@ -0,0 +1,255 @@
+"""Contains a streaming bulk write-back of new fields to INCA documents.
+
+Writing fields back (topic assignments, cluster ids, ...) used to mean building a
+full list of dicts with to_dict("records"), deep-copying it, renaming doc_id to _id
+and calling myinca.database.update_documents(docs, batchsize=2000).
+write_back() instead streams partial updates straight from a DataFrame or a
+Parquet file:
+
+    from usrightmedia.shared.es_writeback import write_back
+
+    stats = write_back(myinca, df10, id_col="doc_id")                     # DataFrame
+    stats = write_back(myinca, "top_topic_with_ids.parquet", columns=[...])  # Parquet file
+
+- rows are converted to update actions chunk by chunk; the payload is never materialized as a whole
+- bulk requests run in parallel, with a bounded number in flight (backpressure on the reader)
+- the batch size adapts to the response times, aiming at `target_latency` seconds per request
+- rejected items (429, e.g., a full write queue) and server errors are retried with exponential backoff
+- throughput is logged every `report_interval` seconds
+
+"""
+import collections
+import concurrent.futures
+import logging
+import math
+import threading
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+LOGGER = logging.getLogger("es_writeback")
+
+# INCA stores all documents under one mapping type (Elasticsearch 6.x still requires it in bulk actions)
+DOC_TYPE = "doc"
+
+# item statuses worth retrying: rejected by a full queue or failed on the server side
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _clean(value):
+    """Make NaN/NaT JSON-serializable as null."""
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value is pd.NaT:
+        return None
+    return value
+
+
+def iter_updates(source, id_col="doc_id", columns=None, chunksize=10000):
+    """Stream (doc_id, fields) pairs from a DataFrame or a Parquet file.
+
+    Args:
+        source (pd.DataFrame, str or iterable): DataFrame, path of a Parquet file, or an
+                                                iterable of (doc_id, fields) pairs (passed through)
+        id_col (str): column holding the ES `_id`; it isn't written as a field
+        columns (list, opt): fields to write; all columns except id_col if None
+        chunksize (int): rows converted to dicts at a time
+
+    Yields:
+        (str, dict): doc_id and the fields to update
+
+    """
+    if not isinstance(source, (pd.DataFrame, str)):
+        yield from source
+        return
+
+    if isinstance(source, pd.DataFrame):
+        columns = columns or [c for c in source.columns if c != id_col]
+        chunks = (
+            source.iloc[start : start + chunksize][[id_col] + columns].to_dict("records")
+            for start in range(0, len(source), chunksize)
+        )
+    else:
+        parquet_file = pq.ParquetFile(source)
+        columns = columns or [c for c in parquet_file.schema_arrow.names if c != id_col]
+        chunks = (
+            batch.to_pylist()
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=[id_col] + columns)
+        )
+
+    for chunk in chunks:
+        for row in chunk:
+            doc_id = row.pop(id_col)
+            yield doc_id, {field: _clean(value) for field, value in row.items()}
+
+
+class AdaptiveBatchSize:
+    """Batch size which grows or shrinks so bulk requests take about `target_latency` seconds."""
+
+    def __init__(self, initial=1000, minimum=100, maximum=10000, target_latency=2.0):
+        self.value = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+
+    def update(self, n_docs, latency):
+        if latency <= 0 or n_docs == 0:
+            return
+        # docs per second of the last request, scaled to the target latency (at most x2 or /2 per step)
+        factor = min(max(self.target_latency / latency, 0.5), 2.0)
+        with self._lock:
+            self.value = int(min(max(n_docs * factor, self.minimum), self.maximum))
+
+
+def _bulk_update(myinca, updates, max_retries, backoff):
+    """Send partial updates in one bulk request, retrying retryable items.
+
+    Returns:
+        counts (Counter): "updated", "failed", "retried"
+        failed (list of (doc_id, error))
+        latency (float): seconds of the first request
+
+    """
+    client = myinca.database.client
+    counts = collections.Counter()
+    failed = []
+    latency = None
+
+    for attempt in range(max_retries + 1):
+        body = []
+        for doc_id, fields in updates:
+            body.append({"update": {"_index": myinca.database.elastic_index, "_type": DOC_TYPE, "_id": doc_id}})
+            body.append({"doc": fields})
+
+        start = time.perf_counter()
+        try:
+            res = client.bulk(body=body)
+        except Exception as e:
+            # the whole request failed (e.g., a timeout): retry all of it
+            res = None
+            error = f"{type(e).__name__}: {e}"
+        if latency is None:
+            latency = time.perf_counter() - start
+
+        retry = []
+        if res is None:
+            retry = updates
+        else:
+            for (doc_id, fields), item in zip(updates, res["items"]):
+                result = item["update"]
+                status = result.get("status", 500)
+                if status < 300:
+                    counts["updated"] += 1
+                elif status in RETRY_STATUSES:
+                    retry.append((doc_id, fields))
+                    error = result.get("error")
+                else:
+                    counts["failed"] += 1
+                    failed.append((doc_id, result.get("error")))
+
+        if not retry:
+            break
+        if attempt == max_retries:
+            counts["failed"] += len(retry)
+            failed.extend((doc_id, error) for doc_id, _ in retry)
+            break
+        counts["retried"] += len(retry)
+        time.sleep(backoff * 2 ** attempt)
+        updates = retry
+
+    return counts, failed, latency
+
+
+def write_back(
+    myinca,
+    source,
+    id_col="doc_id",
+    columns=None,
+    n_workers=4,
+    initial_batchsize=1000,
+    min_batchsize=100,
+    max_batchsize=10000,
+    target_latency=2.0,
+    max_retries=5,
+    backoff=1.0,
+    report_interval=30,
+):
+    """Write fields from a DataFrame or Parquet file back to existing ES documents.
+
+    Args:
+        myinca (object): INCA instance
+        source (pd.DataFrame, str or iterable): DataFrame, path of a Parquet file, or an
+                                                iterable of (doc_id, fields) pairs
+        id_col (str): column holding the ES `_id` (not written as a field)
+        columns (list, opt): fields to write; all other columns if None
+        n_workers (int): number of concurrent bulk requests
+        initial_batchsize, min_batchsize, max_batchsize (int): updates per bulk request
+        target_latency (float): seconds per bulk request the batch size adapts to
+        max_retries (int): retries of rejected items (429) and server errors
+        backoff (float): seconds before the first retry; doubled per retry
+        report_interval (float): seconds between throughput log messages
+
+    Returns:
+        stats (dict): "updated", "failed", "retried", "requests", "docs_per_s" and
+                      "failed_ids" (doc_id -> error of the first 1000 failures)
+
+    """
+    batchsize = AdaptiveBatchSize(initial_batchsize, min_batchsize, max_batchsize, target_latency)
+    updates = iter_updates(source, id_col=id_col, columns=columns)
+
+    def next_batch():
+        batch = []
+        for update in updates:
+            batch.append(update)
+            if len(batch) >= batchsize.value:
+                break
+        return batch
+
+    # every key is in the stats, also when nothing failed or was retried
+    counts = collections.Counter({"updated": 0, "failed": 0, "retried": 0, "requests": 0})
+    failed_ids = {}
+    start = last_report = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = {}
+        while True:
+            # backpressure: read the next batch only while fewer than 2 * n_workers requests are in flight
+            while len(pending) < 2 * n_workers:
+                batch = next_batch()
+                if not batch:
+                    break
+                future = executor.submit(_bulk_update, myinca, batch, max_retries, backoff)
+                pending[future] = len(batch)
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                n_docs = pending.pop(future)
+                batch_counts, batch_failed, latency = future.result()
+                counts.update(batch_counts)
+                counts["requests"] += 1
+                batchsize.update(n_docs, latency)
+                for doc_id, error in batch_failed:
+                    if len(failed_ids) < 1000:
+                        failed_ids[doc_id] = error
+
+            now = time.perf_counter()
+            if now - last_report >= report_interval:
+                LOGGER.info(
+                    f"write-back: {counts['updated']} updated, {counts['failed']} failed, "
+                    f"{counts['updated'] / (now - start):.0f} docs/s, batch size {batchsize.value}"
+                )
+                last_report = now
+
+    elapsed = time.perf_counter() - start
+    stats = dict(counts)
+    stats["docs_per_s"] = counts["updated"] / elapsed if elapsed > 0 else 0.0
+    stats["failed_ids"] = failed_ids
+    LOGGER.info(
+        f"write-back finished: {counts['updated']} updated, {counts['failed']} failed, "
+        f"{counts['retried']} retried in {elapsed:.1f} s ({stats['docs_per_s']:.0f} docs/s)"
+    )
+    return stats
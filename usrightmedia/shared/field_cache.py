@@ -0,0 +1,146 @@
+"""Contains a local, columnar cache of ES document fields keyed by doc_id.
+
+Each cached field is one Parquet file in the cache directory:
+    tweets2_url_ids.parquet     doc_id, _version, tweets2_url_ids
+    topic.parquet               doc_id, _version, topic
+
+A cached value is valid as long as the document's `_version` in ES hasn't changed
+(every update of a document increments it). By default, the versions of the
+requested doc_ids are checked with one lightweight request per batch (no `_source`),
+and only new or changed documents are fetched. With validate=False, cached values
+are used as-is and ES is only asked for doc_ids which aren't cached yet.
+
+    from usrightmedia.shared.field_cache import FieldCache
+
+    cache = FieldCache(os.path.join("..", "..", "data", "02-intermediate", "09-analysis", "field_cache"), myinca)
+    df_clusters = cache.attach(df_clusters, ["tweets2_url_ids", "topic"])
+
+"""
+import logging
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from usrightmedia.shared.es_queries import fetch_by_ids
+
+LOGGER = logging.getLogger("field_cache")
+
+
+class FieldCache:
+    """Parquet cache of selected ES fields per doc_id, invalidated by the document version.
+
+    Args:
+        cache_dir (str): directory holding one Parquet file per field
+        myinca (object): INCA instance
+
+    """
+
+    def __init__(self, cache_dir, myinca):
+        self.cache_dir = cache_dir
+        self.myinca = myinca
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, field):
+        return os.path.join(self.cache_dir, f"{field}.parquet")
+
+    def _read(self, field):
+        path = self._path(field)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=["doc_id", "_version", field]).set_index("doc_id")
+        table = pq.read_table(path)
+        df = table.to_pandas().set_index("doc_id")
+        if pa.types.is_list(table.schema.field(field).type):
+            # Arrow returns lists as numpy arrays; keep them as lists like in ES `_source`
+            df[field] = [v.tolist() if v is not None else None for v in df[field]]
+        return df
+
+    def _write(self, field, df):
+        path = self._path(field)
+        tmp_path = f"{path}.tmp"
+        pq.write_table(pa.Table.from_pandas(df.reset_index(), preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+
+    def _stale_ids(self, doc_ids, cached, validate):
+        """doc_ids which have to be (re-)fetched for at least one field."""
+        if not validate:
+            is_cached = pd.Series(True, index=doc_ids)
+            for df in cached.values():
+                is_cached &= is_cached.index.isin(df.index)
+            return list(is_cached.index[~is_cached])
+
+        versions = pd.Series(
+            {
+                doc["_id"]: doc["_version"]
+                for doc in fetch_by_ids(self.myinca, doc_ids, fields=False, version=True)
+            },
+            dtype="float64",
+        )
+        is_current = pd.Series(True, index=versions.index)
+        for df in cached.values():
+            is_current &= df["_version"].reindex(versions.index) == versions
+        return list(versions.index[~is_current])
+
+    def refresh(self, doc_ids, fields, validate=True):
+        """Fetch the fields of new or changed documents from ES into the cache.
+
+        Args:
+            doc_ids (list of str)
+            fields (list of str)
+            validate (bool): compare the cached versions with ES
+
+        Returns:
+            n_fetched (int): number of documents fetched from ES
+
+        """
+        doc_ids = pd.Index(doc_ids).unique()
+        cached = {field: self._read(field) for field in fields}
+        stale_ids = self._stale_ids(doc_ids, cached, validate)
+        if not stale_ids:
+            return 0
+
+        df_new = pd.DataFrame(
+            [
+                dict({"doc_id": doc["_id"], "_version": doc["_version"]}, **doc.get("_source", {}))
+                for doc in fetch_by_ids(self.myinca, stale_ids, fields=fields, version=True)
+            ],
+            columns=["doc_id", "_version"] + list(fields),
+        ).set_index("doc_id")
+
+        for field in fields:
+            df_field = cached[field]
+            df_field = pd.concat([df_field.drop(df_new.index, errors="ignore"), df_new[["_version", field]]])
+            self._write(field, df_field)
+        LOGGER.info(f"fetched {len(df_new)} of {len(doc_ids)} documents from ES for {fields}")
+        return len(df_new)
+
+    def get(self, doc_ids, fields, validate=True):
+        """Return the fields of the doc_ids, refreshing the cache first.
+
+        Returns:
+            df (pd.DataFrame): index is doc_ids; one column per field
+                               (missing for documents which aren't in ES)
+
+        """
+        self.refresh(doc_ids, fields, validate=validate)
+        return pd.concat(
+            [self._read(field)[field].reindex(pd.Index(doc_ids).unique()) for field in fields],
+            axis=1,
+        )
+
+    def attach(self, df, fields, on="doc_id", validate=True):
+        """Join the fields onto a dataframe (e.g., the multi-cluster dataframe) by doc_id.
+
+        Args:
+            df (pd.DataFrame)
+            fields (list of str)
+            on (str): column of df holding the doc_ids
+            validate (bool): compare the cached versions with ES
+
+        Returns:
+            df (pd.DataFrame): df with one column added per field
+
+        """
+        df_fields = self.get(df[on], fields, validate=validate)
+        return df.merge(df_fields, left_on=on, right_index=True, how="left")
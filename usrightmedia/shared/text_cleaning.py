@@ -0,0 +1,451 @@
+"""Contains a fused, single-pass version of the text-cleaning steps in 05-inca-processing/01-text-processing.ipynb.
+
+The notebook runs INCA's multireplace (Fox News only), remove_html_tags, remove_punctuation,
+remove_stopwords and clean_whitespace as five separate passes: each one reads every outlet
+document from ES and bulk-writes a new field (article_maintext_0 ... article_maintext_4).
+clean_doctype() reads each document once, applies the ordered steps in memory and writes
+the result in one partial update:
+
+    from usrightmedia.shared.text_cleaning import clean_doctype
+
+    clean_doctype(myinca, "foxnews")                           # only writes article_maintext_4
+    clean_doctype(myinca, "foxnews", keep_intermediate=True)   # also article_maintext_0 ... _3
+    clean_doctypes_parallel(myinca, outlet_doctypes, n_processes=8)  # cleaning fanned out to processes
+
+In clean_doctypes_parallel(), the main process scans ES and feeds batches of texts to
+a process pool; each worker compiles an outlet's rule set once, the first time it
+sees the outlet. The cleaned batches stream back to a single bulk writer. The workers
+are started from a fork server, so a script calling it needs an `if __name__ == "__main__":` guard.
+
+Re-runs are incremental: every written field records the SHA-1 of its input text
+(`<field>_input_hash`) and the version of its rule set (`<field>_rules_version`).
+By default only documents without an up-to-date rules version are read from ES
+(newly scraped ones, or all of them after a rule changed), so a daily top-up takes
+time proportional to the new articles. verify=True reads all documents and also
+re-cleans those whose input text changed in place; force=True re-cleans everything.
+
+The steps re-implement INCA's processors with the same parameters. Documents cleaned
+by INCA (the output field without a rules version) are left as they are unless
+force=True; check_parity() compares each step with the fields INCA stored on a sample:
+
+    check_parity(myinca, "foxnews", n=200)   # {"remove_stopwords": {"n": 200, "n_mismatches": 0, ...}, ...}
+
+"""
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import string
+from collections import namedtuple
+
+from usrightmedia.shared.es_queries import query_doctypes, request_options, sample_by_query
+from usrightmedia.shared.es_scan import scan
+from usrightmedia.shared.es_writeback import write_back
+
+LOGGER = logging.getLogger("text_cleaning")
+
+# a cleaning step: a function from text to text and the field its output is stored in
+Step = namedtuple("Step", ["name", "func", "new_key"])
+
+# Fox News: remove lines with only capitalized letters or common punctuation
+# (promo links, links to other content, subheadings) and the generic email signup
+RULES_FOX = [
+    {"regexp": "\\n[A-Z0-9 :,\\'!@\\$\\(\\)\\-\\.\\?\\:\\;\\/]+(?:\\n|$)", "replace_with": ""},
+    {
+        "regexp": "Get all the latest news on coronavirus and more delivered daily to your inbox\\. Sign up here",
+        "replace_with": "",
+    },
+]
+OUTLET_RULES = {"foxnews": RULES_FOX}
+
+# bump when a step changes its output without a change in OUTLET_RULES (e.g., a new stopword list)
+RULES_VERSION = 2
+
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
+# -------------------------------------------------------------------------------------------------------------
+# steps
+
+
+def make_multireplace(rules):
+    """Step function applying regex replacement rules ({"regexp": ..., "replace_with": ...}) in order."""
+    compiled = [(re.compile(rule["regexp"]), rule["replace_with"]) for rule in rules]
+
+    def multireplace(text):
+        for pattern, replace_with in compiled:
+            text = pattern.sub(replace_with, text)
+        return text
+
+    return multireplace
+
+
+def remove_html_tags(text):
+    return _HTML_TAG_RE.sub("", text)
+
+
+def remove_punctuation(text):
+    return text.translate(_PUNCTUATION_TABLE)
+
+
+@functools.lru_cache(maxsize=None)
+def _stopwords(language):
+    # INCA's remove_stopwords uses NLTK's stopword lists
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words(language))
+
+
+def make_remove_stopwords(language="english"):
+    def remove_stopwords(text):
+        stopwords = _stopwords(language)
+        # case-sensitive, like INCA's remove_stopwords
+        return " ".join(word for word in text.split() if word not in stopwords)
+
+    return remove_stopwords
+
+
+def clean_whitespace(text):
+    return " ".join(text.split())
+
+
+@functools.lru_cache(maxsize=None)
+def get_steps(doctype):
+    """The cleaning steps of the notebook for one outlet doctype (compiled once per process).
+
+    Returns:
+        steps (tuple of Step)
+
+    """
+    steps = []
+    if doctype in OUTLET_RULES:
+        steps.append(Step("multireplace", make_multireplace(OUTLET_RULES[doctype]), "article_maintext_0"))
+    steps.extend(
+        [
+            Step("remove_html_tags", remove_html_tags, "article_maintext_1"),
+            Step("remove_punctuation", remove_punctuation, "article_maintext_2"),
+            Step("remove_stopwords", make_remove_stopwords("english"), "article_maintext_3"),
+            Step("clean_whitespace", clean_whitespace, "article_maintext_4"),
+        ]
+    )
+    return tuple(steps)
+
+
+def apply_steps(text, steps, keep_intermediate=False):
+    """Run the steps on one text.
+
+    Returns:
+        fields (dict): new_key -> text of every step (keep_intermediate) or of the last step only
+
+    """
+    fields = {}
+    for step in steps:
+        text = step.func(text) if text else text
+        if keep_intermediate:
+            fields[step.new_key] = text
+    if not keep_intermediate:
+        fields[steps[-1].new_key] = text
+    return fields
+
+
+# -------------------------------------------------------------------------------------------------------------
+# content hashes
+
+
+def get_rules_version(doctype, steps=None):
+    """Version of the rule set of a doctype: changes with RULES_VERSION, the steps or the outlet's rules.
+
+    Returns:
+        version (str): 12 lowercase hex digits (a single token, whatever the ES mapping of the field)
+
+    """
+    steps = steps or get_steps(doctype)
+    rule_set = [RULES_VERSION, [(step.name, step.new_key) for step in steps], OUTLET_RULES.get(doctype)]
+    return hashlib.sha1(json.dumps(rule_set, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_output_keys(steps, keep_intermediate=False):
+    return [step.new_key for step in steps] if keep_intermediate else [steps[-1].new_key]
+
+
+def add_hashes(fields, text, rules_version):
+    """Record the input hash and rules version next to every cleaned field."""
+    input_hash = content_hash(text)
+    for key in list(fields):
+        fields[f"{key}_input_hash"] = input_hash
+        fields[f"{key}_rules_version"] = rules_version
+    return fields
+
+
+def is_current(source, text, output_keys, rules_version):
+    """Whether the cleaned fields of a document (`_source`) were made from this text with this rule set."""
+    input_hash = content_hash(text)
+    return all(
+        source.get(f"{key}_rules_version") == rules_version and source.get(f"{key}_input_hash") == input_hash
+        for key in output_keys
+    )
+
+
+def _query_pending(doctype, output_keys, rules_version, verify, **options):
+    """ES query for the documents of a doctype which may need (re-)cleaning.
+
+    Documents cleaned by INCA (the last output field without a rules version) are
+    excluded; unless verify, so are those with all fields of the current rule set.
+    """
+    last_key = output_keys[-1]
+    cleaned_by_inca = {
+        "bool": {
+            "filter": [{"exists": {"field": last_key}}],
+            "must_not": [{"exists": {"field": f"{last_key}_rules_version"}}],
+        }
+    }
+    must_not = [cleaned_by_inca]
+    if not verify:
+        current = [{"term": {f"{key}_rules_version": rules_version}} for key in output_keys]
+        must_not.append({"bool": {"filter": current}})
+    query = {"bool": {"filter": [{"terms": {"doctype": [doctype]}}], "must_not": must_not}}
+    return request_options({"query": query}, **options)
+
+
+def _iter_texts(myinca, doctype, field, output_keys, rules_version, force, verify, n_slices):
+    """Yield (doc_id, text) of the documents of a doctype which need (re-)cleaning."""
+    if force:
+        query = query_doctypes([doctype], source_includes=[field])
+    else:
+        tracking = [f"{key}_{suffix}" for key in output_keys for suffix in ("input_hash", "rules_version")]
+        query = _query_pending(doctype, output_keys, rules_version, verify, source_includes=[field] + tracking)
+
+    n_read = n_skipped = 0
+    for hits in scan(myinca, query, n_slices=n_slices):
+        for hit in hits:
+            source = hit.get("_source", {})
+            text = source.get(field)
+            if text is None:
+                continue
+            n_read += 1
+            if not force and is_current(source, text, output_keys, rules_version):
+                n_skipped += 1
+                continue
+            yield hit["_id"], text
+    LOGGER.info(f"{doctype}: {n_read - n_skipped} of {n_read} documents read need cleaning")
+
+
+# -------------------------------------------------------------------------------------------------------------
+# parity with INCA
+
+
+def check_parity(myinca, doctype, n=100, seed=42, field="article_maintext"):
+    """Compare each step with the output INCA stored for it, on a random sample of documents.
+
+    Each step is fed INCA's stored input for that step (as in the notebook's five passes),
+    so a difference in one step doesn't carry over to the next ones.
+
+    Returns:
+        parity (dict): step name -> {"n": documents compared, "n_mismatches": int,
+                                     "mismatched_ids": up to 10 doc_ids}
+
+    """
+    steps = get_steps(doctype)
+    input_keys = [field] + [step.new_key for step in steps[:-1]]
+    cleaned_by_inca = [{"terms": {"doctype": [doctype]}}, {"exists": {"field": steps[-1].new_key}}]
+    query = {"query": {"bool": {"filter": cleaned_by_inca}}}
+    query = request_options(query, source_includes=input_keys + [step.new_key for step in steps])
+    docs = sample_by_query(myinca, query, n=n, seed=seed)
+
+    parity = {}
+    for input_key, step in zip(input_keys, steps):
+        result = {"n": 0, "n_mismatches": 0, "mismatched_ids": []}
+        for doc in docs:
+            source = doc.get("_source", {})
+            if source.get(input_key) is None or source.get(step.new_key) is None:
+                continue
+            result["n"] += 1
+            if apply_steps(source[input_key], [step])[step.new_key] != source[step.new_key]:
+                result["n_mismatches"] += 1
+                if len(result["mismatched_ids"]) < 10:
+                    result["mismatched_ids"].append(doc["_id"])
+        parity[step.name] = result
+    LOGGER.info(f"parity with INCA for {doctype}: {parity}")
+    return parity
+
+
+# -------------------------------------------------------------------------------------------------------------
+# pipeline
+
+
+def iter_cleaned(
+    myinca,
+    doctype,
+    field="article_maintext",
+    steps=None,
+    keep_intermediate=False,
+    n_slices=4,
+    force=False,
+    verify=False,
+):
+    """Read the new or affected documents of a doctype once and yield their cleaned fields.
+
+    Yields:
+        (str, dict): doc_id and the new fields (with their hashes), as expected by es_writeback.write_back()
+
+    """
+    steps = steps or get_steps(doctype)
+    rules_version = get_rules_version(doctype, steps)
+    output_keys = get_output_keys(steps, keep_intermediate)
+    for doc_id, text in _iter_texts(myinca, doctype, field, output_keys, rules_version, force, verify, n_slices):
+        yield doc_id, add_hashes(apply_steps(text, steps, keep_intermediate), text, rules_version)
+
+
+def clean_doctype(
+    myinca,
+    doctype,
+    field="article_maintext",
+    steps=None,
+    keep_intermediate=False,
+    n_slices=4,
+    force=False,
+    verify=False,
+    **writeback_options,
+):
+    """Clean the texts of one doctype in a single read-transform-write pass.
+
+    Args:
+        myinca (object): INCA instance
+        doctype (str): outlet doctype
+        field (str): input field
+        steps (list of Step, opt): defaults to get_steps(doctype)
+        keep_intermediate (bool): also write the output of every intermediate step
+        n_slices (int): parallel slices of the ES scan
+        force (bool): re-clean all documents, including those cleaned by INCA, not only new or affected ones
+        verify (bool): also compare the input hashes of documents with an up-to-date rules version
+        **writeback_options: passed to es_writeback.write_back() (n_workers, target_latency, ...)
+
+    Returns:
+        stats (dict): see es_writeback.write_back()
+
+    """
+    LOGGER.info(f"cleaning {doctype}.{field} (keep_intermediate={keep_intermediate}, force={force})")
+    updates = iter_cleaned(myinca, doctype, field, steps, keep_intermediate, n_slices, force, verify)
+    return write_back(myinca, updates, **writeback_options)
+
+
+# -------------------------------------------------------------------------------------------------------------
+# multi-process pipeline
+
+
+def clean_batch(doctype, batch, keep_intermediate=False):
+    """Clean a batch of (doc_id, text) pairs of one doctype; runs in a worker process.
+
+    Returns:
+        list of (str, dict): doc_id and the new fields (with their hashes)
+
+    """
+    steps = get_steps(doctype)
+    rules_version = get_rules_version(doctype)
+    return [
+        (doc_id, add_hashes(apply_steps(text, steps, keep_intermediate), text, rules_version)) for doc_id, text in batch
+    ]
+
+
+def _iter_text_batches(myinca, doctypes, field, keep_intermediate, batchsize, n_slices, force, verify):
+    """Yield (doctype, [(doc_id, text), ...]) batches of the documents which need (re-)cleaning."""
+    for doctype in doctypes:
+        steps = get_steps(doctype)
+        output_keys = get_output_keys(steps, keep_intermediate)
+        texts = _iter_texts(myinca, doctype, field, output_keys, get_rules_version(doctype), force, verify, n_slices)
+        while True:
+            batch = list(itertools.islice(texts, batchsize))
+            if not batch:
+                break
+            yield doctype, batch
+
+
+def get_mp_context():
+    """Start method of the cleaning workers: a fork server where available, else spawn.
+
+    The workers start on the first submit, when the es_scan threads are already running:
+    forking a process with running threads can copy locks held by them.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def iter_cleaned_parallel(
+    myinca,
+    doctypes,
+    field="article_maintext",
+    keep_intermediate=False,
+    n_processes=None,
+    batchsize=2000,
+    n_slices=4,
+    force=False,
+    verify=False,
+):
+    """Clean the texts of the doctypes in a process pool and yield the results as they complete.
+
+    Yields:
+        (str, dict): doc_id and the new fields, as expected by es_writeback.write_back()
+
+    """
+    n_processes = n_processes or os.cpu_count()
+    batches = _iter_text_batches(myinca, doctypes, field, keep_intermediate, batchsize, n_slices, force, verify)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes, mp_context=get_mp_context()) as executor:
+        # a bounded number of batches in flight keeps memory flat
+        pending = {
+            executor.submit(clean_batch, doctype, batch, keep_intermediate)
+            for doctype, batch in itertools.islice(batches, 2 * n_processes)
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for doctype, batch in itertools.islice(batches, len(done)):
+                pending.add(executor.submit(clean_batch, doctype, batch, keep_intermediate))
+            for future in done:
+                yield from future.result()
+
+
+def clean_doctypes_parallel(
+    myinca,
+    doctypes,
+    field="article_maintext",
+    keep_intermediate=False,
+    n_processes=None,
+    batchsize=2000,
+    n_slices=4,
+    force=False,
+    verify=False,
+    **writeback_options,
+):
+    """Clean the texts of several doctypes with a process pool and a single bulk writer.
+
+    Args:
+        myinca (object): INCA instance
+        doctypes (list): outlet doctypes
+        field (str): input field
+        keep_intermediate (bool): also write the output of every intermediate step
+        n_processes (int, opt): worker processes; defaults to the number of cores
+        batchsize (int): texts per task sent to a worker
+        n_slices (int): parallel slices of the ES scan
+        force (bool): re-clean all documents, including those cleaned by INCA, not only new or affected ones
+        verify (bool): also compare the input hashes of documents with an up-to-date rules version
+        **writeback_options: passed to es_writeback.write_back() (n_workers, target_latency, ...)
+
+    Returns:
+        stats (dict): see es_writeback.write_back()
+
+    """
+    LOGGER.info(f"cleaning {field} of {doctypes} with {n_processes or os.cpu_count()} processes (force={force})")
+    updates = iter_cleaned_parallel(
+        myinca, doctypes, field, keep_intermediate, n_processes, batchsize, n_slices, force, verify
+    )
+    return write_back(myinca, updates, **writeback_options)
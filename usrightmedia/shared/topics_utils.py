@@ -1,7 +1,11 @@
 """This module contains functions for using LDA topic modeling."""
 
 import os
+import bisect
 import datetime
+import hashlib
+import itertools
+import re
 import pandas as pd
 import pickle
 import json
@@ -21,6 +25,9 @@ from usrightmedia.shared.loggers import get_logger
 # python -m spacy download en_core_web_lg
 nlp = spacy.load("en_core_web_lg")
 
+# underscore-private: the notebooks star-import this module and define their own LOGGER
+_LOGGER = logging.getLogger("topics_utils")
+
 INPUTS_DIR = os.path.join(
     "..", "..", "data", "02-intermediate", "08-topic-models", "01-inputs"
 )
@@ -98,40 +105,80 @@ https://explosion.ai/demos/displacy-ent https://github.com/explosion/spaCy/blob/
 """
 
 
-def preprocess_docs(docs, docs_type, INPUTS_DIR):
-    """Pre-process which removes empty documents.
-    
-    citation: based off of https://github.com/RaRe-Technologies/gensim/blob/develop/docs/notebooks/atmodel_tutorial.ipynb
+# the token filter only reads lemma, POS, stopword and entity type: the dependency parser is wasted work
+UNUSED_PIPES = ["parser"]
+# texts per spaCy batch (articles are long; spaCy's default of 1000 texts holds many Docs in memory)
+BATCH_SIZE = 200
+# one process by default: each extra process loads its own copy of en_core_web_lg (~1 GB);
+# pass n_process=4 or so where the memory allows it
+N_PROCESS = 1
+
+
+def _filter_tokens(doc, with_offsets=False):
+    """Lemmatize tokens, remove punctuation, remove stopwords, remove certain entity types.
+
+    Returns:
+        lemmas (list of str), or (lemmas, offsets) with with_offsets: the character offset of each token in the text
+
     """
-    processed_docs = []
-    for doc in nlp.pipe(docs):
-        # Process document using Spacy NLP pipeline
-
-        # Lemmatize tokens, remove punctuation, remove stopwords, remove certain entity types
-        doc = [
-            token.lemma_.lower()
-            for token in doc
-            if token.is_alpha
-            and not token.is_stop
-            and token.pos_ in ["NOUN", "ADJ", "ADV"]
-            and token.ent_type_ not in ["PERSON", "DATE", "TIME", "PERCENT", "QUANTITY"]
-            and token.text not in ["trump", "Trump"]
-        ]
-        
-        # pre-processing can result in some docs having no tokens (i.e., length is 0)
-        if len(doc) > 0:
-            processed_docs.append(doc)
+    tokens = [
+        token
+        for token in doc
+        if token.is_alpha
+        and not token.is_stop
+        and token.pos_ in ["NOUN", "ADJ", "ADV"]
+        and token.ent_type_ not in ["PERSON", "DATE", "TIME", "PERCENT", "QUANTITY"]
+        and token.text not in ["trump", "Trump"]
+    ]
+    lemmas = [token.lemma_.lower() for token in tokens]
+    if with_offsets:
+        return lemmas, [token.idx for token in tokens]
+    return lemmas
+
+
+def iter_tokens(docs, as_tuples=False, with_offsets=False, batch_size=BATCH_SIZE, n_process=N_PROCESS):
+    """Process documents with the spaCy pipeline (without unused pipes) and yield their filtered tokens.
+
+    Only one batch of spaCy Docs per process is held in memory at a time.
 
-    docs = processed_docs
-    del processed_docs
+    Args:
+        docs (iterable of str): or of (str, context) pairs with as_tuples, e.g. (text, doc_id)
+        as_tuples (bool): pass a context along with each text
+        with_offsets (bool): tokens are (lemmas, character offsets), see _filter_tokens()
+        batch_size (int): texts per spaCy batch
+        n_process (int): worker processes (-1: one per core)
+
+    Yields:
+        tokens (list of str), or (tokens, context) with as_tuples; in the order of `docs`
 
-    # Add bigrams to docs (only ones that appear 20 times or more).
+    """
+    for item in nlp.pipe(docs, as_tuples=as_tuples, batch_size=batch_size, n_process=n_process, disable=UNUSED_PIPES):
+        if as_tuples:
+            doc, context = item
+            yield _filter_tokens(doc, with_offsets), context
+        else:
+            yield _filter_tokens(item, with_offsets)
+
+
+def add_bigrams(docs):
+    """Add bigrams to docs (only ones that appear 20 times or more)."""
     bigram = Phrases(docs, min_count=20)
     for idx in range(len(docs)):
         for token in bigram[docs[idx]]:
             if "_" in token:
                 # Token is a bigram, add to document.
                 docs[idx].append(token)
+    return docs
+
+
+def preprocess_docs(docs, docs_type, INPUTS_DIR, batch_size=BATCH_SIZE, n_process=N_PROCESS):
+    """Pre-process which removes empty documents.
+    
+    citation: based off of https://github.com/RaRe-Technologies/gensim/blob/develop/docs/notebooks/atmodel_tutorial.ipynb
+    """
+    # pre-processing can result in some docs having no tokens (i.e., length is 0)
+    docs = [doc for doc in iter_tokens(docs, batch_size=batch_size, n_process=n_process) if len(doc) > 0]
+    docs = add_bigrams(docs)
 
     with open(os.path.join(INPUTS_DIR, "docs", f"docs_{docs_type}.pkl"), "wb") as handle:
         pickle.dump(docs, handle)
@@ -139,7 +186,7 @@ def preprocess_docs(docs, docs_type, INPUTS_DIR):
     return docs
 
 
-def preprocess_docs_with_doc_ids(doc_ids, docs, docs_type, INPUTS_DIR):
+def preprocess_docs_with_doc_ids(doc_ids, docs, docs_type, INPUTS_DIR, batch_size=BATCH_SIZE, n_process=N_PROCESS):
     """Pre-process which includes doc_id field.
     *Patch-up: should have included the ID information in preprocess_docs();
                this is a fix so topic assignments can be associated back to their doc_ids from INCA.      
@@ -149,44 +196,26 @@ def preprocess_docs_with_doc_ids(doc_ids, docs, docs_type, INPUTS_DIR):
         docs (list of str)
         docs_type (str): "titles", "leads", "texts"
         INPUTS_DIR (constant)
+        batch_size (int): texts per spaCy batch
+        n_process (int): spaCy worker processes
     
     Returns:
         df (dataframe): 'doc_id' and 'processed_doc' columns
     
     citation: based off of https://github.com/RaRe-Technologies/gensim/blob/develop/docs/notebooks/atmodel_tutorial.ipynb
     """
+    # each doc_id travels with its text through spaCy, so the ids stay aligned with the output
     processed_ids = []
     processed_docs = []
-    for n, doc in enumerate(nlp.pipe(docs)):
-        # Process document using Spacy NLP pipeline
-
-        # Lemmatize tokens, remove punctuation, remove stopwords, remove certain entity types
-        doc = [
-            token.lemma_.lower()
-            for token in doc
-            if token.is_alpha
-            and not token.is_stop
-            and token.pos_ in ["NOUN", "ADJ", "ADV"]
-            and token.ent_type_ not in ["PERSON", "DATE", "TIME", "PERCENT", "QUANTITY"]
-            and token.text not in ["trump", "Trump"]
-        ]
-        
+    for doc, doc_id in iter_tokens(zip(docs, doc_ids), as_tuples=True, batch_size=batch_size, n_process=n_process):
         # pre-processing can result in some docs having no tokens (i.e., length is 0)
         if len(doc) > 0:
-            processed_ids.append(doc_ids[n])
+            processed_ids.append(doc_id)
             processed_docs.append(doc)
 
-    docs = processed_docs
+    docs = add_bigrams(processed_docs)
     del processed_docs
 
-    # Add bigrams to docs (only ones that appear 20 times or more).
-    bigram = Phrases(docs, min_count=20)
-    for idx in range(len(docs)):
-        for token in bigram[docs[idx]]:
-            if "_" in token:
-                # Token is a bigram, add to document.
-                docs[idx].append(token)
-                
     df = pd.DataFrame()
     df['doc_id'] = processed_ids
     df['processed_doc'] = docs
@@ -197,6 +226,156 @@ def preprocess_docs_with_doc_ids(doc_ids, docs, docs_type, INPUTS_DIR):
     return df
 
 
+# =============================================================================================================
+# PREPARE INPUTS: SINGLE SPACY PASS PER ARTICLE
+
+"""
+Titles, leads and texts are sliced from one spaCy pass over `title + TITLE_SEP + text`:
+
+    df_tokens = tokenize_articles(ids, titles, texts, os.path.join(INPUTS_DIR, "docs", "token_cache.parquet"))
+    df_docs_titles = preprocess_articles(df_tokens, "titles", INPUTS_DIR)
+    df_docs_leads = preprocess_articles(df_tokens, "leads", INPUTS_DIR)
+    df_docs_texts = preprocess_articles(df_tokens, "texts", INPUTS_DIR)
+
+The token cache keeps the filtered lemmas of each article with their character offsets
+(plus where the title and the lead end), keyed by doc_id and a hash of the content.
+Re-runs only process new or changed articles.
+"""
+
+# keeps the title and the text in separate sentences
+TITLE_SEP = "\n\n"
+# leads: title + first 100 words of the text
+LEAD_WORDS = 100
+# bump when _filter_tokens() changes
+TOKENS_VERSION = 1
+
+TOKEN_CACHE_COLUMNS = ["doc_id", "content_hash", "lemmas", "offsets", "title_end", "lead_end"]
+
+
+def _content_hash(title, text):
+    key = f"{TOKENS_VERSION}\0{nlp.meta['name']}-{nlp.meta['version']}\0{title}{TITLE_SEP}{text}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _lead_end(title, text):
+    """Character offset in `title + TITLE_SEP + text` where the lead ends."""
+    words = list(itertools.islice(re.finditer(r"\S+", text), LEAD_WORDS))
+    return len(title) + len(TITLE_SEP) + (words[-1].end() if words else 0)
+
+
+def _read_token_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return pd.DataFrame(columns=TOKEN_CACHE_COLUMNS)
+    df = pd.read_parquet(cache_path)
+    # Arrow returns lists as numpy arrays
+    df["lemmas"] = [list(v) for v in df["lemmas"]]
+    df["offsets"] = [list(v) for v in df["offsets"]]
+    return df
+
+
+def tokenize_articles(doc_ids, titles, texts, cache_path, batch_size=BATCH_SIZE, n_process=N_PROCESS):
+    """Lemmatize each article in one spaCy pass over its title and text, reusing cached articles.
+
+    Args:
+        doc_ids (list of str)
+        titles (list of str)
+        texts (list of str)
+        cache_path (str): Parquet file of the token cache
+        batch_size (int): texts per spaCy batch
+        n_process (int): spaCy worker processes
+
+    Returns:
+        df_tokens (dataframe): one row per doc_id, in the order of doc_ids; columns TOKEN_CACHE_COLUMNS
+
+    """
+    df = pd.DataFrame({"doc_id": list(doc_ids), "title": [t or "" for t in titles], "text": [t or "" for t in texts]})
+    df["content_hash"] = [_content_hash(title, text) for title, text in zip(df["title"], df["text"])]
+
+    df_cache = _read_token_cache(cache_path)
+    is_cached = pd.MultiIndex.from_frame(df[["doc_id", "content_hash"]]).isin(
+        pd.MultiIndex.from_frame(df_cache[["doc_id", "content_hash"]])
+    )
+    df_new = df.loc[~is_cached]
+    _LOGGER.info(f"tokenizing {len(df_new)} of {len(df)} articles ({is_cached.sum()} cached)")
+
+    if len(df_new) > 0:
+        articles = (title + TITLE_SEP + text for title, text in zip(df_new["title"], df_new["text"]))
+        rows = list(iter_tokens(articles, with_offsets=True, batch_size=batch_size, n_process=n_process))
+        df_new = df_new.assign(
+            lemmas=[lemmas for lemmas, _ in rows],
+            offsets=[offsets for _, offsets in rows],
+            title_end=df_new["title"].str.len(),
+            lead_end=[_lead_end(title, text) for title, text in zip(df_new["title"], df_new["text"])],
+        )
+        df_cache = pd.concat(
+            [df_cache.loc[~df_cache["doc_id"].isin(df_new["doc_id"])], df_new[TOKEN_CACHE_COLUMNS]],
+            ignore_index=True,
+        )
+        tmp_path = f"{cache_path}.tmp"
+        df_cache.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+
+    return df[["doc_id"]].merge(df_cache.drop_duplicates("doc_id", keep="last"), on="doc_id", how="left")
+
+
+def slice_tokens(df_tokens, docs_type):
+    """Cut the tokens of the titles, leads or texts out of the single pass over title + text.
+
+    Args:
+        df_tokens (dataframe): output of tokenize_articles()
+        docs_type (str): "titles", "leads", "texts"
+
+    Returns:
+        docs (list of list of str): in the order of df_tokens
+
+    """
+    if docs_type not in ["titles", "leads", "texts"]:
+        raise ValueError(f"docs_type must be 'titles', 'leads' or 'texts', got {docs_type}")
+
+    docs = []
+    for lemmas, offsets, title_end, lead_end in zip(
+        df_tokens["lemmas"], df_tokens["offsets"], df_tokens["title_end"], df_tokens["lead_end"]
+    ):
+        # offsets are sorted: bisect finds the first token at or after a boundary
+        if docs_type == "titles":
+            docs.append(lemmas[: bisect.bisect_left(offsets, title_end)])
+        elif docs_type == "leads":
+            docs.append(lemmas[: bisect.bisect_left(offsets, lead_end)])
+        else:
+            docs.append(lemmas[bisect.bisect_left(offsets, title_end + len(TITLE_SEP)) :])
+    return docs
+
+
+def preprocess_articles(df_tokens, docs_type, INPUTS_DIR):
+    """Pre-process from the token cache: same outputs as preprocess_docs() and preprocess_docs_with_doc_ids().
+
+    Args:
+        df_tokens (dataframe): output of tokenize_articles()
+        docs_type (str): "titles", "leads", "texts"
+        INPUTS_DIR (constant)
+
+    Returns:
+        df (dataframe): 'doc_id' and 'processed_doc' columns (empty documents removed)
+
+    """
+    # pre-processing can result in some docs having no tokens (i.e., length is 0)
+    docs = slice_tokens(df_tokens, docs_type)
+    pairs = [(doc_id, doc) for doc_id, doc in zip(df_tokens["doc_id"], docs) if len(doc) > 0]
+    processed_ids = [doc_id for doc_id, _ in pairs]
+    docs = add_bigrams([doc for _, doc in pairs])
+
+    df = pd.DataFrame()
+    df['doc_id'] = processed_ids
+    df['processed_doc'] = docs
+
+    with open(os.path.join(INPUTS_DIR, "docs", f"docs_{docs_type}.pkl"), "wb") as handle:
+        pickle.dump(docs, handle)
+    with open(os.path.join(INPUTS_DIR, "docs", f"docs_{docs_type}_with_inca_ids.pkl"), "wb") as handle:
+        pickle.dump(df, handle)
+
+    return df
+
+
 # Create a dictionary representation of the documents, and filter out frequent and rare words.
 def save_dictionary(docs, docs_type, INPUTS_DIR):
     dictionary = Dictionary(docs)
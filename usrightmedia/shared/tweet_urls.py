@@ -0,0 +1,176 @@
+"""Contains functions to extract the URLs shared in tweets (Twitter API v2 payloads stored in INCA).
+
+Tweets are streamed from ES in batches and each batch is turned into URL rows with
+the filter flags of 02-twitter/03-twitter-prep-urls.ipynb computed on the fly:
+    - is_dupe: the URL appeared earlier within the same tweet
+    - url_netloc: netloc of most_unrolled_url
+    - is_from_tw: the URL is internal to twitter.com
+
+The rows can be written to Parquet one row group per batch, so memory stays bounded
+by the batch size rather than by the number of tweets:
+
+    from inca import Inca
+    from usrightmedia.shared.tweet_urls import write_tweet_urls, read_tweet_urls
+
+    write_tweet_urls(Inca(), "politicians_tweeted_urls.parquet")
+    df = read_tweet_urls("politicians_tweeted_urls.parquet")  # same rows as politicians_tweeted_urls.pkl
+
+"""
+import datetime
+import logging
+from urllib.parse import urlparse
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from usrightmedia.shared.es_queries import query_tw_field_exists
+
+LOGGER = logging.getLogger("tweet_urls")
+
+# tweet fields read by extract_urls()
+SOURCE_FIELDS = ["id", "created_at", "text", "author_id", "author.username", "entities.urls"]
+
+SCHEMA = pa.schema(
+    [
+        ("tweet_id", pa.string()),
+        ("created_at", pa.timestamp("us")),
+        ("text", pa.string()),
+        ("author_id", pa.string()),
+        ("username", pa.string()),
+        ("tweet_url", pa.string()),
+        ("url_id", pa.string()),
+        ("url", pa.string()),
+        ("expanded_url", pa.string()),
+        ("display_url", pa.string()),
+        ("unwound_url", pa.string()),
+        ("most_unrolled_url", pa.string()),
+        ("most_unrolled_field", pa.string()),
+        ("is_dupe", pa.bool_()),
+        ("url_netloc", pa.string()),
+        ("is_from_tw", pa.bool_()),
+    ]
+)
+
+
+def extract_urls(tweet):
+    """Extract the URL(s) included within a tweet, with the filter flags.
+
+    Args:
+        tweet (Twitter API v2 payload)
+
+    Returns:
+        extracted URLs (list of dictionaries):
+            - the tweet-level info is duplicated across every URL dict
+            - at the URL level:
+                - 'url_id' (tweet_id + URL index value within tweet)
+                - 'most_unrolled_url' is the URL for further processing
+                - 'is_dupe', 'url_netloc', 'is_from_tw' (see module docstring)
+
+    """
+    # tweet-level info
+    tweet_id = tweet["id"]
+    created_at = datetime.datetime.strptime(tweet["created_at"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    username = tweet["author"]["username"]
+
+    extracted_urls = []
+    seen = set()
+    for n, t in enumerate(tweet["entities"]["urls"]):
+        r = {
+            "tweet_id": tweet_id,
+            "created_at": created_at,
+            "text": tweet["text"],
+            "author_id": tweet["author_id"],
+            "username": username,
+            "tweet_url": f"https://twitter.com/{username}/status/{tweet_id}",
+            "url_id": f"{tweet_id}_{n}",
+            "url": t.get("url", None),
+            "expanded_url": t.get("expanded_url", None),
+            "display_url": t.get("display_url", None),
+            "unwound_url": t.get("unwound_url", None),
+            "most_unrolled_url": None,
+            "most_unrolled_field": None,
+        }
+
+        # preferred URL version
+        # similar to https://github.com/twitterdev/tweet_parser/blob/master/tweet_parser/getter_methods/tweet_links.py
+        for field in ["unwound_url", "expanded_url", "url"]:
+            if r[field]:
+                r["most_unrolled_url"] = r[field]
+                r["most_unrolled_field"] = field
+                break
+
+        r["is_dupe"] = r["most_unrolled_url"] in seen
+        seen.add(r["most_unrolled_url"])
+        r["url_netloc"] = urlparse(r["most_unrolled_url"]).netloc if r["most_unrolled_url"] else None
+        r["is_from_tw"] = r["url_netloc"] == "twitter.com"
+
+        extracted_urls.append(r)
+
+    return extracted_urls
+
+
+def iter_tweet_url_batches(myinca, query=None, batchsize=10000):
+    """Stream the URLs of tweets in ES as Arrow record batches.
+
+    Args:
+        myinca (object): INCA instance
+        query (dict, opt): ES query; defaults to all tweets with at least one URL
+        batchsize (int): number of tweets per batch
+
+    Yields:
+        batch (pa.RecordBatch): URL rows with the columns of SCHEMA
+
+    """
+    query = query or query_tw_field_exists("entities.urls", source_includes=SOURCE_FIELDS)
+
+    urls = []
+    n_tweets = 0
+    for n_tweets, doc in enumerate(myinca.database.document_generator(query), start=1):
+        urls.extend(extract_urls(doc["_source"]))
+        if n_tweets % batchsize == 0:
+            yield pa.RecordBatch.from_pylist(urls, schema=SCHEMA)
+            urls = []
+            LOGGER.info(f"extracted URLs from {n_tweets} tweets")
+    if urls:
+        yield pa.RecordBatch.from_pylist(urls, schema=SCHEMA)
+    LOGGER.info(f"extracted URLs from {n_tweets} tweets")
+
+
+def write_tweet_urls(myinca, path, query=None, batchsize=10000):
+    """Write the URLs of tweets in ES to a Parquet file, one row group per batch of tweets.
+
+    Args:
+        myinca (object): INCA instance
+        path (str): Parquet file
+        query (dict, opt): ES query; defaults to all tweets with at least one URL
+        batchsize (int): number of tweets per row group
+
+    Returns:
+        n_urls (int): number of rows written
+
+    """
+    n_urls = 0
+    with pq.ParquetWriter(path, SCHEMA) as writer:
+        for batch in iter_tweet_url_batches(myinca, query=query, batchsize=batchsize):
+            writer.write_batch(batch)
+            n_urls += batch.num_rows
+    LOGGER.info(f"wrote {n_urls} URLs to {path}")
+    return n_urls
+
+
+def read_tweet_urls(path, only_external=True, columns=None):
+    """Read the URLs written by write_tweet_urls().
+
+    Args:
+        path (str): Parquet file
+        only_external (bool): keep a URL only if it is distinct within its tweet and
+                              not from 'twitter.com' (as in politicians_tweeted_urls.pkl)
+        columns (list, opt): columns to read
+
+    Returns:
+        df (pd.DataFrame)
+
+    """
+    filters = [("is_dupe", "==", False), ("is_from_tw", "==", False)] if only_external else None
+    table = pq.read_table(path, columns=columns, filters=filters)
+    return table.to_pandas()